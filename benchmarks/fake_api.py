@@ -0,0 +1,481 @@
+import json
+import math
+import time
+from collections import Counter, defaultdict
+from itertools import count
+from threading import Lock
+from typing import Dict, Iterator, List, Optional
+
+import supervisely as sly
+
+# In-memory stand-in for the parts of sly.Api, which are used by the merge engine.
+# Every method counts the HTTP requests the real SDK would send, including the hidden ones,
+# e.g. the image infos fetched by upload_ids without infos, and sleeps for `latency` seconds
+# per request, so API-bound regressions show up in the numbers.
+
+# Default batch size of the bulk methods of the SDK.
+SDK_BATCH_SIZE = 50
+
+
+class FakeApi:
+    def __init__(self, latency: float = 0.0, page_size: int = 500):
+        self.latency = latency
+        self.page_size = page_size
+        self.calls = Counter()
+        # Dataset and project meta of the last annotation upload, shared by all the threads
+        # like in sly.Api.
+        self.optimization_context = {}
+
+        self.projects: Dict[int, sly.ProjectInfo] = {}
+        self.metas: Dict[int, dict] = {}
+        self.datasets: Dict[int, sly.DatasetInfo] = {}
+        self.images: Dict[int, sly.ImageInfo] = {}
+        # Image IDs of every dataset, so listings don't scan all the images.
+        self.dataset_images: Dict[int, List[int]] = defaultdict(list)
+        # Annotations are kept serialized, so downloads and uploads pay for (de)serialization
+        # like with the real instance.
+        self.anns: Dict[int, str] = {}
+
+        self._ids = count(1)
+        self._lock = Lock()
+        # Guards writes, which check names before adding, e.g. image uploads.
+        self.write_lock = Lock()
+
+        self.project = FakeProjectApi(self)
+        self.dataset = FakeDatasetApi(self)
+        self.image = FakeImageApi(self)
+        self.annotation = FakeAnnotationApi(self)
+
+    def request(self, endpoint: str, requests_count: int = 1):
+        for _ in range(requests_count):
+            self.post(endpoint, {})
+
+    def post(self, method: str, data: dict, **kwargs):
+        # All the requests go through post like in sly.Api, so they can be instrumented.
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, method: str, params: dict, **kwargs):
+        return self.post(method, params)
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    def get_free_name(self, name: str, taken_names: List[str]) -> str:
+        free_name = name
+        suffix = 1
+        while free_name in taken_names:
+            free_name = f"{name}_{suffix:03d}"
+            suffix += 1
+        return free_name
+
+
+class FakeProjectApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+
+    def create(
+        self,
+        workspace_id: int,
+        name: str,
+        type: str = "images",
+        description: str = "",
+        change_name_if_conflict: bool = False,
+    ) -> sly.ProjectInfo:
+        self._api.request("project.create")
+        taken_names = [
+            info.name for info in self._api.projects.values() if info.workspace_id == workspace_id
+        ]
+        if name in taken_names:
+            if not change_name_if_conflict:
+                raise ValueError(f"Project with name {name} already exists.")
+            name = self._api.get_free_name(name, taken_names)
+
+        project_id = self._api.next_id()
+        self._api.projects[project_id] = sly.ProjectInfo(
+            id=project_id,
+            name=name,
+            description=description,
+            size=0,
+            readme="",
+            workspace_id=workspace_id,
+            images_count=0,
+            items_count=0,
+            datasets_count=0,
+            created_at=_now(),
+            updated_at=_now(),
+            type=str(type),
+            reference_image_url=None,
+            custom_data={},
+            backup_archive={},
+            team_id=1,
+            settings={},
+            import_settings={},
+            version=None,
+        )
+        self._api.metas[project_id] = sly.ProjectMeta().to_json()
+        return self._api.projects[project_id]
+
+    def get_info_by_id(self, id: int) -> Optional[sly.ProjectInfo]:
+        self._api.request("project.get_info_by_id")
+        info = self._api.projects.get(id)
+        if info is None:
+            return None
+        dataset_ids = [info.id for info in self._api.datasets.values() if info.project_id == id]
+        images_count = sum(len(self._api.dataset_images[dataset_id]) for dataset_id in dataset_ids)
+        datasets_count = len(dataset_ids)
+        return info._replace(
+            images_count=images_count, items_count=images_count, datasets_count=datasets_count
+        )
+
+    def get_meta(self, id: int) -> dict:
+        self._api.request("project.get_meta")
+        return json.loads(json.dumps(self._api.metas[id]))
+
+    def update_meta(self, id: int, meta) -> None:
+        self._api.request("project.update_meta")
+        if isinstance(meta, sly.ProjectMeta):
+            meta = meta.to_json()
+        meta = json.loads(json.dumps(meta))
+
+        # IDs are assigned by the instance and kept for the existing names.
+        old_meta = self._api.metas[id]
+        class_ids = {obj_class["title"]: obj_class["id"] for obj_class in old_meta["classes"]}
+        tag_ids = {tag_meta["name"]: tag_meta["id"] for tag_meta in old_meta["tags"]}
+        for obj_class in meta["classes"]:
+            obj_class["id"] = class_ids.get(obj_class["title"]) or self._api.next_id()
+        for tag_meta in meta["tags"]:
+            tag_meta["id"] = tag_ids.get(tag_meta["name"]) or self._api.next_id()
+
+        self._api.metas[id] = meta
+
+    def get_stats(self, id: int) -> dict:
+        """Returns only the label counts of the classes, which are used by the merge."""
+        self._api.request("project.get_stats")
+        counts = Counter()
+        for dataset_info in self._api.datasets.values():
+            if dataset_info.project_id != id:
+                continue
+            for image_id in self._api.dataset_images[dataset_info.id]:
+                for object_json in json.loads(self._api.anns[image_id])["objects"]:
+                    counts[object_json["classTitle"]] += 1
+        items = [
+            {"objectClass": {"name": obj_class["title"]}, "total": counts[obj_class["title"]]}
+            for obj_class in self._api.metas[id]["classes"]
+        ]
+        return {"objects": {"items": items}}
+
+
+class FakeDatasetApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+
+    def create(
+        self,
+        project_id: int,
+        name: str,
+        description: str = "",
+        change_name_if_conflict: bool = False,
+        parent_id: Optional[int] = None,
+    ) -> sly.DatasetInfo:
+        self._api.request("dataset.create")
+        taken_names = [
+            info.name
+            for info in self._api.datasets.values()
+            if info.project_id == project_id and info.parent_id == parent_id
+        ]
+        if name in taken_names:
+            if not change_name_if_conflict:
+                raise ValueError(f"Dataset with name {name} already exists.")
+            name = self._api.get_free_name(name, taken_names)
+
+        dataset_id = self._api.next_id()
+        project_info = self._api.projects[project_id]
+        self._api.datasets[dataset_id] = sly.DatasetInfo(
+            id=dataset_id,
+            name=name,
+            description=description,
+            size=0,
+            project_id=project_id,
+            images_count=0,
+            items_count=0,
+            created_at=_now(),
+            updated_at=_now(),
+            reference_image_url=None,
+            team_id=project_info.team_id,
+            workspace_id=project_info.workspace_id,
+            parent_id=parent_id,
+        )
+        return self._api.datasets[dataset_id]
+
+    def get_info_by_id(self, id: int) -> Optional[sly.DatasetInfo]:
+        self._api.request("dataset.get_info_by_id")
+        return self._api.datasets.get(id)
+
+    def get_list(
+        self,
+        project_id: int,
+        filters: Optional[List[dict]] = None,
+        recursive: bool = False,
+        parent_id: Optional[int] = None,
+    ) -> List[sly.DatasetInfo]:
+        self._api.request("dataset.get_list")
+        return [
+            info
+            for info in self._api.datasets.values()
+            if info.project_id == project_id and (recursive or info.parent_id == parent_id)
+        ]
+
+    def get_info_by_name(
+        self, project_id: int, name: str, fields=None, parent_id: Optional[int] = None
+    ) -> Optional[sly.DatasetInfo]:
+        self._api.request("dataset.get_list")
+        for info in self._api.datasets.values():
+            if info.project_id == project_id and info.parent_id == parent_id and info.name == name:
+                return info
+        return None
+
+
+class FakeImageApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+        self.tag = FakeTagApi(api)
+
+    def get_list(
+        self,
+        dataset_id: Optional[int] = None,
+        filters: Optional[List[dict]] = None,
+        force_metadata_for_links: bool = True,
+        project_id: Optional[int] = None,
+        **kwargs,
+    ) -> List[sly.ImageInfo]:
+        image_infos = _filter_by_ids(self._list_images(dataset_id, project_id), filters)
+        self._api.request(
+            "image.get_list", max(1, math.ceil(len(image_infos) / self._api.page_size))
+        )
+        return image_infos
+
+    def get_list_generator(
+        self,
+        dataset_id: Optional[int] = None,
+        filters: Optional[List[dict]] = None,
+        batch_size: Optional[int] = None,
+        force_metadata_for_links: bool = True,
+        project_id: Optional[int] = None,
+        **kwargs,
+    ) -> Iterator[List[sly.ImageInfo]]:
+        image_infos = _filter_by_ids(self._list_images(dataset_id, project_id), filters)
+        # Empty listings take one request too.
+        if not image_infos:
+            self._api.request("image.get_list_generator")
+        for batch in sly.batched(image_infos, batch_size=batch_size or self._api.page_size):
+            self._api.request("image.get_list_generator")
+            yield batch
+
+    def upload_ids(
+        self,
+        dataset_id: int,
+        names: List[str],
+        ids: List[int],
+        progress_cb=None,
+        metas: Optional[List[dict]] = None,
+        batch_size: int = SDK_BATCH_SIZE,
+        infos=None,
+        **kwargs,
+    ) -> List[sly.ImageInfo]:
+        if infos is None and ids:
+            # Infos of the source images are fetched by get_info_by_id_batch.
+            self._api.request("image.get_info_by_id")
+            self._api.request("image.get_info_by_id_batch", math.ceil(len(ids) / SDK_BATCH_SIZE))
+        self._api.request("image.upload_ids", math.ceil(len(ids) / batch_size))
+        if metas is None:
+            metas = [{}] * len(ids)
+
+        with self._api.write_lock:
+            taken_names = {image_info.name for image_info in self._get_dataset_images(dataset_id)}
+            for name in names:
+                if name in taken_names:
+                    raise ValueError(
+                        f"Image with name {name} already exists in dataset {dataset_id}."
+                    )
+                taken_names.add(name)
+
+            return [
+                self.add_image(dataset_id, name, self._api.images[source_id], meta)
+                for name, source_id, meta in zip(names, ids, metas)
+            ]
+
+    def add_image(
+        self, dataset_id: int, name: str, source_info: sly.ImageInfo, meta: Optional[dict] = None
+    ) -> sly.ImageInfo:
+        """Adds a copy of the image with an empty annotation, no request is counted."""
+        image_info = source_info._replace(
+            id=self._api.next_id(),
+            name=name,
+            labels_count=0,
+            dataset_id=dataset_id,
+            created_at=_now(),
+            updated_at=_now(),
+            meta=meta or {},
+            tags=[],
+        )
+        self._api.images[image_info.id] = image_info
+        self._api.dataset_images[dataset_id].append(image_info.id)
+        self._api.anns[image_info.id] = json.dumps(
+            sly.Annotation((image_info.height, image_info.width)).to_json()
+        )
+        return image_info
+
+    def add_tag_batch(
+        self,
+        image_ids: List[int],
+        tag_id: int,
+        value=None,
+        project_meta=None,
+        batch_size: int = 100,
+        tag_meta=None,
+    ):
+        self._api.request("image.add_tag_batch", math.ceil(len(image_ids) / batch_size))
+        for image_id in image_ids:
+            image_info = self._api.images[image_id]
+            tags = image_info.tags + [{"tagId": tag_id, "value": value, "id": self._api.next_id()}]
+            self._api.images[image_id] = image_info._replace(tags=tags)
+
+    def remove_batch(self, ids: List[int], progress_cb=None, batch_size: int = SDK_BATCH_SIZE):
+        self._api.request("image.remove_batch", math.ceil(len(ids) / batch_size))
+        with self._api.write_lock:
+            for image_id in ids:
+                image_info = self._api.images.pop(image_id)
+                self._api.dataset_images[image_info.dataset_id].remove(image_id)
+                self._api.anns.pop(image_id, None)
+
+    def _list_images(
+        self, dataset_id: Optional[int], project_id: Optional[int]
+    ) -> List[sly.ImageInfo]:
+        if project_id is None:
+            return self._get_dataset_images(dataset_id)
+        return [
+            image_info
+            for info in self._api.datasets.values()
+            if info.project_id == project_id
+            for image_info in self._get_dataset_images(info.id)
+        ]
+
+    def _get_dataset_images(self, dataset_id: int) -> List[sly.ImageInfo]:
+        return [self._api.images[image_id] for image_id in self._api.dataset_images[dataset_id]]
+
+
+class FakeTagApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+
+    def get_name_to_id_map(self, project_id: int) -> Dict[str, int]:
+        self._api.request("image.tag.get_name_to_id_map")
+        tag_metas = self._api.metas[project_id]["tags"]
+        return {tag_meta["name"]: tag_meta["id"] for tag_meta in tag_metas}
+
+
+class FakeAnnotationApi:
+    def __init__(self, api: FakeApi):
+        self._api = api
+
+    def download_json_batch(
+        self, dataset_id: int, image_ids: List[int], progress_cb=None, **kwargs
+    ) -> List[dict]:
+        self._api.request(
+            "annotation.download_json_batch", math.ceil(len(image_ids) / SDK_BATCH_SIZE)
+        )
+        return [json.loads(self._api.anns[image_id]) for image_id in image_ids]
+
+    def upload_anns(
+        self, img_ids: List[int], anns: List[sly.Annotation], progress_cb=None, **kwargs
+    ):
+        self._api.request("annotation.upload_anns", math.ceil(len(img_ids) / SDK_BATCH_SIZE))
+        for image_id, ann in zip(img_ids, anns):
+            self.set_ann_json(image_id, ann.to_json())
+
+    def upload_jsons(
+        self, img_ids: List[int], ann_jsons: List[dict], progress_cb=None, **kwargs
+    ):
+        if not img_ids:
+            return
+        # The SDK gets the dataset of the images for every call, and its project and meta
+        # if the optimization context has another dataset.
+        self._api.request("image.get_info_by_id")
+        dataset_id = self._api.images[img_ids[0]].dataset_id
+        context = self._api.optimization_context
+        project_id = context.get("project_id")
+        project_meta = context.get("project_meta")
+        if context.get("dataset_id") != dataset_id:
+            context["dataset_id"] = dataset_id
+            project_id, project_meta = None, None
+        if project_meta is None:
+            if project_id is None:
+                self._api.request("dataset.get_info_by_id")
+                context["project_id"] = self._api.datasets[dataset_id].project_id
+            self._api.request("project.get_meta")
+            context["project_meta"] = self._api.metas[context["project_id"]]
+
+        self._api.request("annotation.upload_jsons", math.ceil(len(img_ids) / SDK_BATCH_SIZE))
+        for image_id, ann_json in zip(img_ids, ann_jsons):
+            self.set_ann_json(image_id, ann_json)
+
+    def copy_batch_by_ids(
+        self,
+        src_image_ids: List[int],
+        dst_image_ids: List[int],
+        batch_size: int = SDK_BATCH_SIZE,
+        save_source_date: bool = True,
+    ):
+        """Copies annotations and image tags, tags are matched by names like on the instance."""
+        self._api.request(
+            "annotation.copy_batch_by_ids", math.ceil(len(src_image_ids) / batch_size)
+        )
+        for src_image_id, dst_image_id in zip(src_image_ids, dst_image_ids):
+            self.set_ann_json(dst_image_id, json.loads(self._api.anns[src_image_id]))
+
+            src_info = self._api.images[src_image_id]
+            dst_info = self._api.images[dst_image_id]
+            src_tag_names = self._get_tag_names(src_info.dataset_id)
+            dst_tag_names = self._get_tag_names(dst_info.dataset_id)
+            dst_tag_ids = {name: tag_id for tag_id, name in dst_tag_names.items()}
+            tags = [
+                {"tagId": dst_tag_ids[src_tag_names[tag["tagId"]]], "value": tag.get("value")}
+                for tag in src_info.tags
+            ]
+            self._api.images[dst_image_id] = dst_info._replace(tags=tags)
+
+    def _get_tag_names(self, dataset_id: int) -> Dict[int, str]:
+        project_id = self._api.datasets[dataset_id].project_id
+        tag_metas = self._api.metas[project_id]["tags"]
+        return {tag_meta["id"]: tag_meta["name"] for tag_meta in tag_metas}
+
+    def set_ann_json(self, image_id: int, ann_json: dict):
+        self._api.anns[image_id] = json.dumps(ann_json)
+        image_info = self._api.images[image_id]
+        self._api.images[image_id] = image_info._replace(
+            labels_count=len(ann_json.get("objects", [])), updated_at=_now()
+        )
+
+
+def _filter_by_ids(
+    image_infos: List[sly.ImageInfo], filters: Optional[List[dict]]
+) -> List[sly.ImageInfo]:
+    # Only the ID filters of the merge are supported.
+    operators = {">=": lambda a, b: a >= b, "<=": lambda a, b: a <= b, "in": lambda a, b: a in b}
+    for image_filter in filters or []:
+        if image_filter["field"] != "id" or image_filter["operator"] not in operators:
+            raise NotImplementedError(f"Filter {image_filter} is not supported.")
+        compare = operators[image_filter["operator"]]
+        image_infos = [info for info in image_infos if compare(info.id, image_filter["value"])]
+    return image_infos
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
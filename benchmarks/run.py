@@ -0,0 +1,254 @@
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import supervisely as sly
+
+import src.config as config
+from benchmarks.fake_api import FakeApi
+from src.merge import MergeSpec, merge_projects
+
+# Benchmarks of the merge engine on synthetic projects in the in-memory fake API:
+#   python -m benchmarks.run
+#   python -m benchmarks.run --scenario "name conflicts" --latency 0.01 --json results.json
+# Every scenario is run twice on the fresh data: the first run measures wall time and
+# API calls, the second one measures peak memory, because tracing slows Python down.
+# Use --scale to change the number of images, e.g. --scale 10 for the stress runs,
+# and --remap-processes to remap annotations in a process pool.
+
+WORKSPACE_ID = 1
+
+Scenario = namedtuple(
+    "Scenario",
+    [
+        "name",
+        "projects_count",
+        "datasets_count",
+        "images_count",
+        "objects_count",
+        "tags_count",
+        "dataset_structure",
+        # Every dataset has a chain of nested datasets with images, e.g. ds_0/level_1/level_2.
+        "nesting_depth",
+    ],
+    defaults=[1],
+)
+
+# Image names repeat in every dataset and classes and tags with the same names have different
+# shapes and value types in odd projects, so every scenario has name and meta conflicts.
+SCENARIOS = [
+    Scenario("small", 2, 2, 100, 5, 2, "Save original names"),
+    Scenario("many datasets", 3, 30, 20, 5, 2, "Use hierarchical structure"),
+    Scenario("name conflicts", 4, 5, 400, 3, 2, "Merge into one dataset"),
+    Scenario("tag heavy", 2, 2, 500, 3, 30, "Separate dataset for each project"),
+    Scenario("large", 4, 5, 500, 10, 5, "Merge into one dataset"),
+    Scenario("nested datasets", 2, 3, 50, 3, 2, "Use hierarchical structure", 3),
+]
+
+
+def create_projects(api: FakeApi, scenario: Scenario, scale: float = 1.0) -> List[int]:
+    """Creates input projects of the scenario without counting the requests."""
+    project_ids = []
+    images_count = max(1, int(scenario.images_count * scale))
+
+    for project_index in range(scenario.projects_count):
+        project_id = api.project.create(WORKSPACE_ID, f"Project {project_index}").id
+        meta = get_project_meta(project_index, scenario.tags_count)
+        api.project.update_meta(project_id, meta)
+        meta = sly.ProjectMeta.from_json(api.project.get_meta(project_id))
+        tag_map = api.image.tag.get_name_to_id_map(project_id)
+
+        for dataset_index in range(scenario.datasets_count):
+            parent_id = None
+            for depth in range(scenario.nesting_depth):
+                dataset_name = f"level_{depth}" if depth else f"ds_{dataset_index}"
+                dataset_id = api.dataset.create(project_id, dataset_name, parent_id=parent_id).id
+                for image_index in range(images_count):
+                    add_image(
+                        api, dataset_id, f"image_{image_index:05d}.jpg", meta, tag_map, scenario
+                    )
+                parent_id = dataset_id
+
+        project_ids.append(project_id)
+
+    api.reset_calls()
+    return project_ids
+
+
+def get_project_meta(project_index: int, tags_count: int) -> sly.ProjectMeta:
+    conflicting_geometry = sly.Polygon if project_index % 2 else sly.Rectangle
+    conflicting_value_type = (
+        sly.TagValueType.ANY_STRING if project_index % 2 else sly.TagValueType.ANY_NUMBER
+    )
+    obj_classes = [
+        sly.ObjClass("car", sly.Rectangle),
+        sly.ObjClass("person", conflicting_geometry),
+        sly.ObjClass(f"class_{project_index}", sly.Rectangle),
+    ]
+    tag_metas = [sly.TagMeta("score", conflicting_value_type)] + [
+        sly.TagMeta(f"tag_{tag_index}", sly.TagValueType.NONE) for tag_index in range(tags_count)
+    ]
+    return sly.ProjectMeta(obj_classes=obj_classes, tag_metas=tag_metas)
+
+
+def add_image(
+    api: FakeApi,
+    dataset_id: int,
+    name: str,
+    meta: sly.ProjectMeta,
+    tag_map: Dict[str, int],
+    scenario: Scenario,
+):
+    height, width = 480, 640
+    image_id = api.next_id()
+    score = 1 if meta.get_tag_meta("score").value_type == sly.TagValueType.ANY_NUMBER else "1"
+    image_tags = [{"tagId": tag_map["score"], "value": score}] + [
+        {"tagId": tag_map[f"tag_{tag_index}"], "value": None}
+        for tag_index in range(scenario.tags_count)
+    ]
+    api.images[image_id] = sly.ImageInfo(
+        id=image_id,
+        name=name,
+        link=None,
+        hash=f"hash_{image_id}",
+        mime="image/jpeg",
+        ext="jpg",
+        size=100000,
+        width=width,
+        height=height,
+        labels_count=0,
+        dataset_id=dataset_id,
+        created_at=None,
+        updated_at=None,
+        meta={},
+        path_original=None,
+        full_storage_url=None,
+        tags=image_tags,
+    )
+    api.dataset_images[dataset_id].append(image_id)
+
+    labels = []
+    for object_index in range(scenario.objects_count):
+        obj_class = meta.obj_classes.items()[object_index % len(meta.obj_classes)]
+        top, left = object_index * 10 % height, object_index * 10 % width
+        if obj_class.geometry_type == sly.Polygon:
+            geometry = sly.Polygon(
+                [
+                    sly.PointLocation(top, left),
+                    sly.PointLocation(top, left + 20),
+                    sly.PointLocation(top + 20, left + 20),
+                ]
+            )
+        else:
+            geometry = sly.Rectangle(top, left, top + 20, left + 20)
+        tags = [sly.Tag(meta.get_tag_meta("tag_0"))] if scenario.tags_count else []
+        labels.append(sly.Label(geometry, obj_class, tags=tags))
+
+    ann = sly.Annotation((height, width), labels=labels)
+    api.annotation.set_ann_json(image_id, ann.to_json())
+
+
+def run_scenario(scenario: Scenario, latency: float, scale: float, trace_memory: bool) -> dict:
+    api = FakeApi(latency=latency)
+    project_ids = create_projects(api, scenario, scale)
+    spec = MergeSpec(
+        workspace_id=WORKSPACE_ID,
+        project_ids=project_ids,
+        conflict_settings=config.ConflictSettings(
+            image_conflicts="Rename", class_conflicts="Rename"
+        ),
+        dataset_structure=scenario.dataset_structure,
+        output_project_name="Merged project",
+        include_empty_classes=False,
+    )
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        output_project_info = merge_projects(api, spec, data_dir)
+        elapsed = time.perf_counter() - start
+        peak_memory = None
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    input_images_count = sum(
+        len(api.dataset_images[info.id])
+        for info in api.datasets.values()
+        if info.project_id in project_ids
+    )
+    if output_project_info.images_count != input_images_count:
+        raise RuntimeError(
+            f"Scenario {scenario.name}: {output_project_info.images_count} images were merged "
+            f"instead of {input_images_count}."
+        )
+
+    return {
+        "scenario": scenario.name,
+        "images": input_images_count,
+        "wall_time": elapsed,
+        "peak_memory": peak_memory,
+        "api_calls": dict(sorted(api.calls.items())),
+    }
+
+
+def print_result(result: dict):
+    api_calls = result["api_calls"]
+    print(
+        f"{result['scenario']}: {result['images']} images, {result['wall_time']:.2f} s, "
+        f"{result['images'] / result['wall_time']:.0f} images/s, "
+        f"{sum(api_calls.values())} API calls"
+    )
+    if result["peak_memory"] is not None:
+        print(f"  peak memory: {result['peak_memory'] / 2**20:.1f} MB")
+    for endpoint, calls_count in api_calls.items():
+        print(f"  {endpoint}: {calls_count}")
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark merge on synthetic projects.")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="Scenarios to run, all by default.",
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per API request.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier of images count.")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory run.")
+    parser.add_argument(
+        "--remap-processes",
+        type=int,
+        default=config.REMAP_PROCESSES,
+        help="Number of annotation remapping processes, REMAP_PROCESSES env by default.",
+    )
+    parser.add_argument("--json", help="Path to save the results as JSON.")
+    args = parser.parse_args(args)
+
+    sly.logger.setLevel("WARNING")
+    config.REMAP_PROCESSES = args.remap_processes
+
+    results = []
+    for scenario in SCENARIOS:
+        if args.scenario and scenario.name not in args.scenario:
+            continue
+        result = run_scenario(scenario, args.latency, args.scale, trace_memory=False)
+        if not args.no_memory:
+            result["peak_memory"] = run_scenario(
+                scenario, args.latency, args.scale, trace_memory=True
+            )["peak_memory"]
+        print_result(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
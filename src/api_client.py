@@ -0,0 +1,235 @@
+import random
+import time
+from bisect import bisect_left
+from threading import BoundedSemaphore, Lock
+from typing import Dict, List, Optional
+
+import requests
+import supervisely as sly
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+
+import src.config as config
+
+# Requests, which were rejected by the server before processing, so any of them can be retried.
+REJECTED_STATUS_CODES = {429}
+# Status codes of the failures, after which only idempotent requests are retried, because
+# the server may have processed the request.
+RETRY_STATUS_CODES = {408, 500, 502, 503, 504}
+# Endpoints with any of these parts only read data, e.g. "images.list" or "projects.meta".
+READ_ENDPOINT_PARTS = {"info", "list", "meta", "stats", "download"}
+# Writes, which set the same state when repeated, unlike the ones creating images or tags.
+IDEMPOTENT_ENDPOINTS = {
+    "annotations.bulk.add",
+    "annotations.bulk.copy",
+    "images.editInfo",
+    "projects.meta.update",
+}
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average and bursts of up to `capacity` requests."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class LatencyHistograms:
+    """Counts of the request latencies of every endpoint by the bounds of the buckets."""
+
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self._counts: Dict[str, List[int]] = {}
+        self._durations: Dict[str, float] = {}
+        self._retries: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def add(self, endpoint: str, latency: float, retried: bool = False):
+        with self._lock:
+            counts = self._counts.setdefault(endpoint, [0] * (len(self.bounds) + 1))
+            counts[bisect_left(self.bounds, latency)] += 1
+            self._durations[endpoint] = self._durations.get(endpoint, 0.0) + latency
+            if retried:
+                self._retries[endpoint] = self._retries.get(endpoint, 0) + 1
+
+    def to_json(self) -> dict:
+        labels = [f"<={bound}" for bound in self.bounds] + [f">{self.bounds[-1]}"]
+        histograms = {}
+        with self._lock:
+            for endpoint, counts in sorted(self._counts.items()):
+                requests_count = sum(counts)
+                histograms[endpoint] = {
+                    "requests": requests_count,
+                    "retries": self._retries.get(endpoint, 0),
+                    "mean": round(self._durations[endpoint] / requests_count, 3),
+                    "p50": self._get_percentile(counts, 0.5),
+                    "p95": self._get_percentile(counts, 0.95),
+                    "buckets": dict(zip(labels, counts)),
+                }
+        return histograms
+
+    def _get_percentile(self, counts: List[int], fraction: float) -> Optional[float]:
+        # Percentiles are estimated by the upper bounds of the buckets, None if above all bounds.
+        rank = fraction * sum(counts)
+        total = 0
+        for bound, count in zip(self.bounds, counts):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+
+class MergeApi(sly.Api):
+    """API client of the merge with pooled connections, rate limiting and retries.
+
+    The SDK opens a new connection for every request and retries every failed request,
+    including the ones creating images, which may have been processed by the server.
+    This client sends requests through one session with a pool of connections, limits the
+    number of concurrent requests and their rate, and retries failures with exponential
+    backoff and full jitter: rejected requests (429) and connect timeouts of any endpoint,
+    and timeouts and server errors of idempotent endpoints only. Latencies of every request
+    are counted in per-endpoint histograms, which are saved to the merge report.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=config.API_MAX_CONNECTIONS)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._in_flight = BoundedSemaphore(config.API_MAX_IN_FLIGHT)
+        self._rate_limiter = None
+        if config.API_RATE_LIMIT > 0:
+            self._rate_limiter = TokenBucket(config.API_RATE_LIMIT, config.API_RATE_BURST)
+        self.latency = LatencyHistograms(config.API_LATENCY_BUCKETS)
+
+    @classmethod
+    def from_api(cls, api: sly.Api) -> "MergeApi":
+        """Creates the client for the same server and user as the given API."""
+        return cls(api.server_address, api.token, api_server_address=api._api_server_address)
+
+    def post(
+        self,
+        method: str,
+        data: Dict,
+        retries: Optional[int] = None,
+        stream: Optional[bool] = False,
+        raise_error: Optional[bool] = False,
+    ) -> requests.Response:
+        self._check_https_redirect()
+        url = self.api_server_address + "/v3/" + method
+        if type(data) is bytes:
+            return self._request("POST", method, url, data=data, stream=stream)
+        if isinstance(data, (MultipartEncoder, MultipartEncoderMonitor)):
+            # Encoders are read while sending, so their requests can't be repeated.
+            headers = {**self.headers, "Content-Type": data.content_type}
+            return self._request(
+                "POST", method, url, can_retry=False, data=data, headers=headers, stream=stream
+            )
+        json_body = {**data, **self.additional_fields} if type(data) is dict else data
+        return self._request("POST", method, url, json=json_body, stream=stream)
+
+    def get(
+        self,
+        method: str,
+        params: Dict,
+        retries: Optional[int] = None,
+        stream: Optional[bool] = False,
+        use_public_api: Optional[bool] = True,
+    ) -> requests.Response:
+        self._check_https_redirect()
+        url = self.api_server_address + "/v3/" + method
+        if use_public_api is False:
+            url = self.server_address.rstrip("/") + "/" + method
+        json_body = {**params, **self.additional_fields} if type(params) is dict else params
+        return self._request("GET", method, url, params=json_body, stream=stream)
+
+    def _request(
+        self, http_method: str, endpoint: str, url: str, can_retry: bool = True, **kwargs
+    ) -> requests.Response:
+        kwargs.setdefault("headers", self.headers)
+        idempotent = is_idempotent(endpoint)
+        attempt = 0
+        while True:
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                with self._in_flight:
+                    response = self._session.request(
+                        http_method, url, timeout=(config.API_CONNECT_TIMEOUT, None), **kwargs
+                    )
+                if response.status_code != requests.codes.ok:  # pylint: disable=no-member
+                    self._raise_for_status(response)
+                self.latency.add(endpoint, time.perf_counter() - start, retried=attempt > 0)
+                return response
+            except requests.RequestException as e:
+                self.latency.add(endpoint, time.perf_counter() - start, retried=attempt > 0)
+                if (
+                    not can_retry
+                    or attempt >= config.API_RETRIES
+                    or not is_retryable(e, idempotent)
+                ):
+                    raise
+                delay = get_retry_delay(e, attempt)
+                attempt += 1
+                sly.logger.warning(
+                    f"Request to {endpoint} failed: {e}, retrying in {delay:.1f} s "
+                    f"({attempt}/{config.API_RETRIES})."
+                )
+                time.sleep(delay)
+
+
+def is_idempotent(endpoint: str) -> bool:
+    return endpoint in IDEMPOTENT_ENDPOINTS or not READ_ENDPOINT_PARTS.isdisjoint(
+        endpoint.split(".")
+    )
+
+
+def is_retryable(exception: requests.RequestException, idempotent: bool) -> bool:
+    # Request wasn't sent if the connection wasn't established.
+    if isinstance(exception, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exception, requests.exceptions.HTTPError):
+        status_code = getattr(exception.response, "status_code", None)
+        if status_code in REJECTED_STATUS_CODES:
+            return True
+        return idempotent and status_code in RETRY_STATUS_CODES
+    return idempotent and isinstance(
+        exception,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def get_retry_delay(exception: requests.RequestException, attempt: int) -> float:
+    delay = random.uniform(
+        0, min(config.API_RETRY_MAX_DELAY, config.API_RETRY_BASE_DELAY * 2**attempt)
+    )
+    # Server tells when the rate limit is reset, the jitter still spreads the retries.
+    response = getattr(exception, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after is not None and retry_after.isdigit():
+        delay += min(float(retry_after), config.API_RETRY_MAX_DELAY)
+    return delay
@@ -0,0 +1,117 @@
+import time
+from threading import Lock
+from typing import Any, Callable, List, Optional
+
+import requests
+import supervisely as sly
+
+# Status codes, which mean that the request was too large or too slow for the server.
+SIZE_ERROR_CODES = {413}
+TIMEOUT_ERROR_CODES = {408, 504}
+
+
+class AdaptiveBatchSize:
+    """Batch size of an upload, which adapts to the measured payload bytes and latency.
+
+    The size is doubled while batches are fast and light, and is reduced when a batch takes
+    longer than `target_latency` or sends more than `max_bytes`, always within the bounds.
+    If a batch fails because it's too large, the size is halved and the batch is retried,
+    and the size never grows to the failed one again.
+    Timed out batches are retried only for idempotent uploads, because the server may have
+    processed them. The size is shared by all the workers, which upload the same entities.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_size: int,
+        min_size: int,
+        max_size: int,
+        target_latency: float,
+        max_bytes: int,
+        idempotent: bool,
+        get_bytes_sent: Optional[Callable[[], int]] = None,
+    ):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.idempotent = idempotent
+        self._get_bytes_sent = get_bytes_sent
+        self._size = min(max(initial_size, min_size), max_size)
+        # Largest size, which is allowed after the failures.
+        self._ceiling = max_size
+        self._lock = Lock()
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return self._size
+
+    def upload(self, items: List, upload_batch: Callable[[List], Any]) -> List[Any]:
+        """Uploads items in batches of the current size, returns results of every batch."""
+        results = []
+        start = 0
+        while start < len(items):
+            batch = items[start:start + self.size]
+
+            bytes_before = self._get_bytes_sent() if self._get_bytes_sent else 0
+            batch_start = time.perf_counter()
+            try:
+                result = upload_batch(batch)
+            except Exception as e:
+                if not self._is_retryable(e) or len(batch) <= self.min_size:
+                    raise
+                self._shrink(len(batch))
+                sly.logger.warning(
+                    f"Batch of {len(batch)} items failed in {self.name}: {e}, "
+                    f"retrying with batch size {self.size}."
+                )
+                continue
+            latency = time.perf_counter() - batch_start
+            bytes_sent = self._get_bytes_sent() - bytes_before if self._get_bytes_sent else 0
+
+            self._update(len(batch), latency, bytes_sent)
+            results.append(result)
+            start += len(batch)
+
+        return results
+
+    def _is_retryable(self, exception: Exception) -> bool:
+        if isinstance(exception, requests.exceptions.HTTPError):
+            status_code = getattr(exception.response, "status_code", None)
+            if status_code in SIZE_ERROR_CODES:
+                return True
+            return self.idempotent and status_code in TIMEOUT_ERROR_CODES
+        # The SDK retries timed out requests itself and raises RetryError when it gives up.
+        return self.idempotent and isinstance(
+            exception, (requests.exceptions.Timeout, requests.exceptions.RetryError)
+        )
+
+    def _shrink(self, failed_size: int):
+        with self._lock:
+            self._ceiling = max(self.min_size, min(self._ceiling, failed_size - 1))
+            self._size = max(self.min_size, min(self._size, failed_size // 2))
+
+    def _update(self, batch_size: int, latency: float, bytes_sent: int):
+        with self._lock:
+            # Size is changed only by full batches, last batches of the lists are usually smaller.
+            if batch_size < self._size:
+                return
+
+            size = self._size
+            if latency > self.target_latency:
+                size = int(size * self.target_latency / latency)
+            elif latency < self.target_latency / 2 and bytes_sent < self.max_bytes / 2:
+                size *= 2
+            if bytes_sent > 0:
+                size = min(size, int(self.max_bytes * batch_size / bytes_sent))
+
+            size = min(max(size, self.min_size), self._ceiling)
+            if size != self._size:
+                sly.logger.debug(
+                    f"Batch size of {self.name} was changed from {self._size} to {size} "
+                    f"after {batch_size} items in {latency:.2f} s, {bytes_sent} bytes."
+                )
+                self._size = size
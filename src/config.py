@@ -0,0 +1,94 @@
+import os
+from collections import namedtuple
+
+# Settings of the merge engine, which don't depend on the app environment,
+# so the engine can be imported without starting the app.
+
+ConflictSettings = namedtuple(
+    "ConflictSettings",
+    [
+        "image_conflicts",
+        "class_conflicts",
+        "duplicate_images",
+    ],
+    defaults=["Keep all"],
+)
+
+# Images are merged only if they match all the set fields. Every field except the classes
+# is checked on the listed image infos, before the annotations are downloaded.
+ImageFilter = namedtuple(
+    "ImageFilter",
+    [
+        # Glob pattern of image names, e.g. "*.png".
+        "name_pattern",
+        # Images with any of these image tags.
+        "tag_names",
+        # Images with labels of any of these classes, checked on the downloaded annotations.
+        "class_names",
+        "min_labels_count",
+        # Number of images sampled from every input project, 0 to merge all images.
+        "sample_size",
+        "sample_mode",
+        "sample_seed",
+    ],
+    defaults=["", [], [], 0, 0, "Random", 0],
+)
+
+IMAGE_CONFLICTS = ["Skip", "Rename"]
+CLASS_CONFLICTS = ["Skip", "Rename"]
+# Images with the same content hash are duplicates.
+DUPLICATE_IMAGES = ["Keep all", "Skip duplicates", "Merge annotations"]
+# Stratified samples take images from every dataset in proportion to its size.
+SAMPLE_MODES = ["Random", "Stratified by dataset"]
+DATASET_CONFLICTS = [
+    "Save original names",
+    "Merge into one dataset",
+    "Separate dataset for each project",
+    "Use hierarchical structure",
+]
+# Default batch size of sly.batched and of the bulk methods of the SDK.
+SDK_BATCH_SIZE = 50
+TAG_BATCH_SIZE = 100
+# Number of images which are listed, processed and uploaded at once.
+UPLOAD_WINDOW_SIZE = int(os.getenv("UPLOAD_WINDOW_SIZE", 1000))
+# Bounds of the adaptive batch sizes of image and annotation uploads.
+UPLOAD_BATCH_MIN_SIZE = int(os.getenv("UPLOAD_BATCH_MIN_SIZE", 5))
+UPLOAD_BATCH_MAX_SIZE = int(os.getenv("UPLOAD_BATCH_MAX_SIZE", 500))
+# Batches are reduced when they take longer (seconds) or send more (bytes) than this.
+UPLOAD_BATCH_TARGET_LATENCY = float(os.getenv("UPLOAD_BATCH_TARGET_LATENCY", 5))
+UPLOAD_BATCH_MAX_BYTES = int(os.getenv("UPLOAD_BATCH_MAX_BYTES", 10 * 2**20))
+# Number of datasets which are merged concurrently.
+MERGE_WORKERS = int(os.getenv("MERGE_WORKERS", 4))
+# Number of windows which can wait between two stages of the dataset pipeline.
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 2))
+# Number of processes which remap annotations, 0 to remap them in the dataset threads.
+# Useful for projects with heavy geometries, which must be converted to the output classes.
+REMAP_PROCESSES = int(os.getenv("REMAP_PROCESSES", 0))
+# Number of annotations which are sent to a remapping process at once.
+REMAP_CHUNK_SIZE = int(os.getenv("REMAP_CHUNK_SIZE", 100))
+# Limits of the merge API client: pooled connections, concurrent requests and requests per
+# second with bursts of up to API_RATE_BURST requests, the rate is not limited if it's 0.
+API_MAX_CONNECTIONS = int(os.getenv("API_MAX_CONNECTIONS", 16))
+API_MAX_IN_FLIGHT = int(os.getenv("API_MAX_IN_FLIGHT", 16))
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", 0))
+API_RATE_BURST = int(os.getenv("API_RATE_BURST", 20))
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", 10))
+# Failed requests are retried with exponential backoff from the base delay (seconds).
+API_RETRIES = int(os.getenv("API_RETRIES", 8))
+API_RETRY_BASE_DELAY = float(os.getenv("API_RETRY_BASE_DELAY", 0.5))
+API_RETRY_MAX_DELAY = float(os.getenv("API_RETRY_MAX_DELAY", 60))
+# Upper bounds (seconds) of the buckets of the API latency histograms in the merge report.
+API_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Number of images in a shard of the sharded merge.
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", 10000))
+# Shard is claimed again by another worker, if its worker didn't renew the claim in this
+# time (seconds), e.g. because the worker was killed.
+SHARD_LEASE_TIME = float(os.getenv("SHARD_LEASE_TIME", 300))
+# Seconds to wait for the lock of the SQLite files, which may be shared by the shard workers.
+SQLITE_TIMEOUT = float(os.getenv("SQLITE_TIMEOUT", 60))
+JOURNAL_FILENAME = "merge_journal.db"
+REPORT_FILENAME = "merge_report_{output_project_id}.json"
+SYNC_INDEX_FILENAME = "sync_index.db"
+SHARD_MANIFEST_FILENAME = "shard_manifest.db"
+# Key of the output image meta with the source image ID and update time, used by the sync.
+SOURCE_META_KEY = "merge_source"
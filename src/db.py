@@ -0,0 +1,27 @@
+import sqlite3
+from threading import Lock
+from typing import List
+
+import supervisely as sly
+
+# Older SQLite versions don't allow more than 999 parameters in one query.
+MAX_QUERY_IDS = 500
+
+
+def fetch_by_ids(
+    connection: sqlite3.Connection, lock: Lock, query: str, params: tuple, ids: List[int]
+) -> List[tuple]:
+    """Runs the query for the IDs in batches and returns rows of all the batches.
+
+    The query must have an `IN ({placeholders})` clause for the IDs after the `params`.
+    """
+    rows = []
+    for batched_ids in sly.batched(ids, batch_size=MAX_QUERY_IDS):
+        placeholders = ", ".join("?" * len(batched_ids))
+        with lock:
+            rows.extend(
+                connection.execute(
+                    query.format(placeholders=placeholders), (*params, *batched_ids)
+                ).fetchall()
+            )
+    return rows
@@ -0,0 +1,92 @@
+from collections import defaultdict
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+import supervisely as sly
+
+import src.config as config
+
+
+class DuplicateIndex:
+    """Index of the input images by content hash.
+
+    The first image with every hash is kept, the next ones are its duplicates. Images must be
+    added in the merge order, so the same image is kept when the merge is resumed.
+    Images without hash (e.g. some links) are never treated as duplicates.
+    If the kept image is dropped by the merge, its first duplicate is kept instead.
+    """
+
+    def __init__(self):
+        self._kept_image_ids: Dict[str, int] = {}
+        # Kept image ID -> (input project ID, image info) of its duplicates.
+        self._duplicates: Dict[int, List[Tuple[int, sly.ImageInfo]]] = defaultdict(list)
+        # (input project ID, image info) of the duplicates, which are kept instead of the dropped
+        # images, but may be skipped as duplicates by their jobs already.
+        self._promoted: List[Tuple[int, sly.ImageInfo]] = []
+        # Guards the promotions, images are dropped by the merge workers.
+        self._lock = Lock()
+        self.duplicates_count = 0
+
+    def add(self, project_id: int, image_info: sly.ImageInfo):
+        if not image_info.hash:
+            return
+        kept_image_id = self._kept_image_ids.setdefault(image_info.hash, image_info.id)
+        if kept_image_id != image_info.id:
+            self._duplicates[kept_image_id].append((project_id, image_info))
+            self.duplicates_count += 1
+
+    def is_duplicate(self, image_info: sly.ImageInfo) -> bool:
+        if not image_info.hash:
+            return False
+        return self._kept_image_ids.get(image_info.hash, image_info.id) != image_info.id
+
+    def get_duplicates(self, image_id: int) -> List[Tuple[int, sly.ImageInfo]]:
+        return self._duplicates.get(image_id, [])
+
+    def drop(self, image_id: int, image_hash: Optional[str]):
+        """Promotes the first duplicate of the kept image, which is skipped by its name or filtered
+        out, so the content is still merged. Other duplicates become duplicates of the promoted one.
+        """
+        if not image_hash:
+            return
+        with self._lock:
+            if self._kept_image_ids.get(image_hash) != image_id:
+                return
+            duplicates = self._duplicates.pop(image_id, [])
+            if not duplicates:
+                return
+            promoted = duplicates[0]
+            self._kept_image_ids[image_hash] = promoted[1].id
+            if len(duplicates) > 1:
+                self._duplicates[promoted[1].id] = duplicates[1:]
+            self._promoted.append(promoted)
+            self.duplicates_count -= 1
+
+    def pop_promoted(self) -> List[Tuple[int, sly.ImageInfo]]:
+        with self._lock:
+            promoted, self._promoted = self._promoted, []
+        return promoted
+
+
+def index_duplicates(
+    api: sly.Api,
+    datasets: List[Tuple[int, int]],
+    is_included: Optional[Callable[[int, sly.ImageInfo], bool]] = None,
+) -> DuplicateIndex:
+    """Lists images of the (input project ID, input dataset ID) pairs in the given order.
+
+    Only images accepted by `is_included` are indexed, so filtered out images keep nothing.
+    """
+    duplicate_index = DuplicateIndex()
+    for project_id, dataset_id in datasets:
+        for image_infos in api.image.get_list_generator(
+            dataset_id, batch_size=config.UPLOAD_WINDOW_SIZE, force_metadata_for_links=False
+        ):
+            for image_info in image_infos:
+                if is_included is None or is_included(project_id, image_info):
+                    duplicate_index.add(project_id, image_info)
+
+    sly.logger.info(
+        f"Found {duplicate_index.duplicates_count} duplicate images in {len(datasets)} datasets."
+    )
+    return duplicate_index
@@ -0,0 +1,232 @@
+import math
+from collections import OrderedDict, defaultdict
+from typing import List
+
+import supervisely as sly
+
+import src.config as config
+from src.dedup import DuplicateIndex
+from src.image_filter import get_tag_names, is_active, matches_info, sample_projects
+from src.layout import get_output_datasets, get_output_layout
+from src.merge import MergeSpec, can_copy_annotations
+from src.meta_cache import MetaCache
+from src.meta_plan import plan_meta
+from src.name_index import NameIndex
+from src.sync_index import get_synced_images, is_changed
+
+
+class MergeEstimate:
+    """Result of a dry run: what the merge would produce and how many API calls it needs."""
+
+    def __init__(self):
+        self.output_datasets_count = 0
+        self.images_count = 0
+        self.skipped_images_count = 0
+        self.renamed_images_count = 0
+        self.duplicate_images_count = 0
+        self.unchanged_images_count = 0
+        self.replaced_images_count = 0
+        self.filtered_images_count = 0
+        self.objects_count = 0
+        self.tags_count = 0
+        self.classes_count = 0
+        self.renamed_classes_count = 0
+        self.skipped_classes_count = 0
+        self.tag_metas_count = 0
+        self.api_calls = OrderedDict(
+            (stage, 0)
+            for stage in [
+                "meta fetch",
+                "meta update",
+                "dataset creation",
+                "listing",
+                "annotation download",
+                "image upload",
+                "annotation upload",
+                "tag upload",
+            ]
+        )
+
+    def to_lines(self) -> List[str]:
+        lines = [
+            f"Output datasets: {self.output_datasets_count}",
+            f"Images: {self.images_count} "
+            f"({self.renamed_images_count} renamed, {self.skipped_images_count} skipped, "
+            f"{self.duplicate_images_count} duplicates, {self.filtered_images_count} filtered out)",
+            f"Objects: {self.objects_count}",
+            f"Image tags: {self.tags_count}",
+            f"Classes: {self.classes_count} "
+            f"({self.renamed_classes_count} renamed, {self.skipped_classes_count} skipped)",
+            f"Tag metas: {self.tag_metas_count}",
+            f"API calls: {sum(self.api_calls.values())}",
+        ]
+        if self.unchanged_images_count or self.replaced_images_count:
+            lines.insert(
+                2,
+                f"Synced images: {self.unchanged_images_count} unchanged, "
+                f"{self.replaced_images_count} replaced",
+            )
+        lines.extend(f"  {stage}: {count}" for stage, count in self.api_calls.items())
+        return lines
+
+
+def estimate_merge(api: sly.Api, spec: MergeSpec) -> MergeEstimate:
+    """Resolves the merge using only listings and metas, nothing is written or downloaded."""
+    estimate = MergeEstimate()
+    meta_cache = MetaCache(api)
+    project_ids = spec.project_ids
+    conflict_settings = spec.conflict_settings
+
+    output_meta = None
+    synced_images = {}
+    if spec.sync_project_id is not None:
+        output_meta = meta_cache.get_meta(spec.sync_project_id)
+        synced_images = {
+            synced_image.input_image_id: synced_image
+            for synced_image in get_synced_images(api, spec.sync_project_id)
+        }
+        estimate.api_calls["meta fetch"] += 1
+        estimate.api_calls["listing"] += 1
+
+    meta_plan = plan_meta(
+        meta_cache, project_ids, conflict_settings.class_conflicts, output_meta=output_meta
+    )
+    # Meta and image tag map of every input project and image tag map of the output project.
+    estimate.api_calls["meta fetch"] += 2 * len(project_ids) + 1
+    estimate.api_calls["meta update"] += 1 if spec.include_empty_classes else 2
+    estimate.classes_count = len(meta_plan.output_meta.obj_classes)
+    estimate.tag_metas_count = len(meta_plan.output_meta.tag_metas)
+    for class_names in meta_plan.class_names.values():
+        for name, output_name in class_names.items():
+            if output_name is None:
+                estimate.skipped_classes_count += 1
+            elif output_name != name:
+                estimate.renamed_classes_count += 1
+
+    # Annotations of these projects are copied server-side, the same way as in the merge.
+    image_filter = spec.image_filter or config.ImageFilter()
+    clone_project_ids = set()
+    if can_copy_annotations(spec):
+        clone_project_ids = {
+            project_id for project_id in project_ids if meta_plan.is_identity(project_id)
+        }
+    # Classes of the copied annotations are counted by the project stats.
+    if not spec.include_empty_classes:
+        estimate.api_calls["meta fetch"] += len(clone_project_ids)
+
+    layout = get_output_layout(api, meta_cache, project_ids, spec.dataset_structure)
+    output_datasets = get_output_datasets(layout)
+    estimate.output_datasets_count = len(output_datasets)
+    estimate.api_calls["dataset creation"] += len(output_datasets)
+    # Datasets of every input project and images of every output dataset for its name index.
+    estimate.api_calls["listing"] += len(project_ids) + len(output_datasets)
+
+    # Output datasets don't exist yet, so their name indexes start empty. Names in the synced
+    # datasets are not listed, changed images keep their names there.
+    name_indexes = {
+        output_dataset.key: NameIndex(api, None, names=set())
+        for output_dataset in output_datasets
+    }
+
+    # Classes can't be filtered without annotations, so the estimate includes all labeled images.
+    sampled_image_ids = None
+    if image_filter.sample_size:
+        sampled_image_ids = sample_projects(
+            api,
+            meta_cache,
+            image_filter,
+            [(item.input_project_id, item.input_dataset.id) for item in layout],
+        )
+        estimate.api_calls["listing"] += len(layout)
+
+    # Images are listed in the merge order, so duplicates are found the same way as in the merge.
+    duplicate_index = DuplicateIndex()
+    skip_duplicates = conflict_settings.duplicate_images != "Keep all"
+    merge_duplicates = conflict_settings.duplicate_images == "Merge annotations"
+    if skip_duplicates:
+        estimate.api_calls["listing"] += len(layout)
+
+    for item in layout:
+        tag_names = meta_plan.tag_names[item.input_project_id]
+        input_tag_map = meta_cache.get_tag_map(item.input_project_id)
+        reversed_input_tag_map = {v: k for k, v in input_tag_map.items()}
+
+        input_image_infos = api.image.get_list(
+            item.input_dataset.id, force_metadata_for_links=False
+        )
+        estimate.api_calls["listing"] += max(
+            1, math.ceil(len(input_image_infos) / config.UPLOAD_WINDOW_SIZE)
+        )
+        if is_active(image_filter):
+            tag_names_by_id = get_tag_names(meta_cache, item.input_project_id)
+            included_image_infos = [
+                image_info
+                for image_info in input_image_infos
+                if (sampled_image_ids is None or image_info.id in sampled_image_ids)
+                and matches_info(image_filter, image_info, tag_names_by_id)
+            ]
+            estimate.filtered_images_count += len(input_image_infos) - len(included_image_infos)
+            input_image_infos = included_image_infos
+
+        for image_info in input_image_infos:
+            duplicate_index.add(item.input_project_id, image_info)
+
+        for window in sly.batched(input_image_infos, batch_size=config.UPLOAD_WINDOW_SIZE):
+            if skip_duplicates:
+                duplicates = [info for info in window if duplicate_index.is_duplicate(info)]
+                window = [info for info in window if not duplicate_index.is_duplicate(info)]
+                estimate.duplicate_images_count += len(duplicates)
+                if merge_duplicates:
+                    estimate.objects_count += sum(info.labels_count for info in duplicates)
+                    estimate.api_calls["annotation download"] += math.ceil(
+                        len(duplicates) / config.SDK_BATCH_SIZE
+                    )
+            if spec.sync_project_id is not None:
+                changed = [info for info in window if is_changed(info, synced_images.get(info.id))]
+                replaced_count = sum(info.id in synced_images for info in changed)
+                estimate.unchanged_images_count += len(window) - len(changed)
+                estimate.replaced_images_count += replaced_count
+                estimate.api_calls["image upload"] += math.ceil(
+                    replaced_count / config.SDK_BATCH_SIZE
+                )
+                window = changed
+            output_names = name_indexes[item.output_dataset.key].reserve(
+                [image_info.name for image_info in window], conflict_settings.image_conflicts
+            )
+            uploaded_count = 0
+            window_tags = defaultdict(int)
+            for image_info, output_name in zip(window, output_names):
+                if output_name is None:
+                    estimate.skipped_images_count += 1
+                    continue
+                if output_name != image_info.name:
+                    estimate.renamed_images_count += 1
+                uploaded_count += 1
+                estimate.objects_count += image_info.labels_count
+                for tag in image_info.tags:
+                    if tag_names.get(reversed_input_tag_map.get(tag.get("tagId"))):
+                        window_tags[(tag.get("tagId"), tag.get("value"))] += 1
+
+            estimate.images_count += uploaded_count
+            estimate.tags_count += sum(window_tags.values())
+            if item.input_project_id in clone_project_ids:
+                # Copied annotations bring their image tags with them.
+                window_tags.clear()
+            else:
+                estimate.api_calls["annotation download"] += math.ceil(
+                    len(window) / config.SDK_BATCH_SIZE
+                )
+            # Upload batches start from the SDK batch size and adapt during the merge.
+            estimate.api_calls["image upload"] += math.ceil(uploaded_count / config.SDK_BATCH_SIZE)
+            annotation_batches_count = math.ceil(uploaded_count / config.SDK_BATCH_SIZE)
+            if item.input_project_id not in clone_project_ids:
+                # The SDK also gets the info of an image of every uploaded batch.
+                annotation_batches_count *= 2
+            estimate.api_calls["annotation upload"] += annotation_batches_count
+            estimate.api_calls["tag upload"] += sum(
+                math.ceil(count / config.TAG_BATCH_SIZE) for count in window_tags.values()
+            )
+
+    sly.logger.info(f"Estimated merge of {len(project_ids)} projects: {estimate.to_lines()}")
+
+    return estimate
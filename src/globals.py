@@ -1,16 +1,17 @@
 import os
-from collections import namedtuple
 
 import supervisely as sly
 
 from dotenv import load_dotenv
 
-ConflictSettings = namedtuple(
-    "ConflictSettings",
-    [
-        "image_conflicts",
-        "class_conflicts",
-    ],
+from src.config import (  # noqa: F401
+    CLASS_CONFLICTS,
+    DATASET_CONFLICTS,
+    DUPLICATE_IMAGES,
+    IMAGE_CONFLICTS,
+    SAMPLE_MODES,
+    ConflictSettings,
+    ImageFilter,
 )
 
 if sly.is_development():
@@ -20,14 +21,6 @@ api = sly.Api.from_env()
 
 SLY_APP_DATA_DIR = sly.app.get_data_dir()
 
-IMAGE_CONFLICTS = ["Skip", "Rename"]
-CLASS_CONFLICTS = ["Skip", "Rename"]
-DATASET_CONFLICTS = [
-    "Save original names",
-    "Merge into one dataset",
-    "Separate dataset for each project",
-    "Use hierarchical structure",
-]
 INIT_PROJECTS_COUNT = 2
 
 
@@ -44,7 +37,9 @@ class State:
         self.conflict_settings = None
 
         self.output_project_id = None
-        self.output_project_meta = None
+
+        # Set by the Cancel button, the running merge stops at its next batch.
+        self.cancel_event = None
 
 
 STATE = State()
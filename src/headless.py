@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+from typing import List, Optional
+
+import supervisely as sly
+from dotenv import load_dotenv
+
+import src.config as config
+from src.api_client import MergeApi
+from src.merge import MergeSpec, merge_projects
+
+# Runs the merge without the app UI, e.g. from scripts or scheduled tasks:
+#   python -m src.headless --project-ids 1 2 3 --workspace-id 4 --data-dir /tmp/merge
+# Settings can also be loaded from a JSON file with the keys of SPEC_KEYS, see README:
+#   python -m src.headless --spec spec.json
+
+# Keys of the JSON spec. Conflict settings are accepted both as a nested "conflict_settings"
+# object like in MergeSpec and as the flat keys like the command line arguments.
+SPEC_KEYS = {
+    "project_ids",
+    "workspace_id",
+    "conflict_settings",
+    *config.ConflictSettings._fields,
+    "dataset_structure",
+    "output_project_name",
+    "include_empty_classes",
+    "sync_project_id",
+    "image_filter",
+}
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Merge image projects without the app UI.")
+    add_merge_arguments(parser)
+    return parser.parse_args(args)
+
+
+def add_merge_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--spec", help="Path to the JSON file with merge settings.")
+    parser.add_argument("--project-ids", type=int, nargs="+", help="IDs of the input projects.")
+    parser.add_argument(
+        "--workspace-id",
+        type=int,
+        help="ID of the workspace for the output project, WORKSPACE_ID env by default.",
+    )
+    # Defaults are the same as in the app UI.
+    parser.add_argument(
+        "--image-conflicts", choices=config.IMAGE_CONFLICTS, default=config.IMAGE_CONFLICTS[0]
+    )
+    parser.add_argument(
+        "--class-conflicts", choices=config.CLASS_CONFLICTS, default=config.CLASS_CONFLICTS[0]
+    )
+    parser.add_argument(
+        "--duplicate-images", choices=config.DUPLICATE_IMAGES, default=config.DUPLICATE_IMAGES[0]
+    )
+    parser.add_argument(
+        "--dataset-structure", choices=config.DATASET_CONFLICTS, default=config.DATASET_CONFLICTS[0]
+    )
+    parser.add_argument("--output-project-name", default="")
+    parser.add_argument("--include-empty-classes", action="store_true")
+    parser.add_argument(
+        "--sync-project-id",
+        type=int,
+        help="ID of the existing output project, only new and changed images are merged into it.",
+    )
+    parser.add_argument("--name-pattern", default="", help="Glob pattern of image names.")
+    parser.add_argument("--tag-names", nargs="+", default=[], help="Merge images with any tag.")
+    parser.add_argument(
+        "--class-names", nargs="+", default=[], help="Merge images with labels of any class."
+    )
+    parser.add_argument("--min-labels-count", type=int, default=0)
+    parser.add_argument(
+        "--sample-size", type=int, default=0, help="Number of images sampled from every project."
+    )
+    parser.add_argument(
+        "--sample-mode", choices=config.SAMPLE_MODES, default=config.SAMPLE_MODES[0]
+    )
+    parser.add_argument("--sample-seed", type=int, default=0)
+    parser.add_argument(
+        "--data-dir",
+        default=os.environ.get("SLY_APP_DATA_DIR"),
+        help="Directory for the merge journal, SLY_APP_DATA_DIR env by default.",
+    )
+
+
+def get_merge_spec(args: argparse.Namespace) -> MergeSpec:
+    if args.spec:
+        spec_json = load_spec_json(args.spec)
+    else:
+        spec_json = {
+            "project_ids": args.project_ids,
+            "workspace_id": args.workspace_id,
+            "image_conflicts": args.image_conflicts,
+            "class_conflicts": args.class_conflicts,
+            "duplicate_images": args.duplicate_images,
+            "dataset_structure": args.dataset_structure,
+            "output_project_name": args.output_project_name,
+            "include_empty_classes": args.include_empty_classes,
+            "sync_project_id": args.sync_project_id,
+            "image_filter": {
+                "name_pattern": args.name_pattern,
+                "tag_names": args.tag_names,
+                "class_names": args.class_names,
+                "min_labels_count": args.min_labels_count,
+                "sample_size": args.sample_size,
+                "sample_mode": args.sample_mode,
+                "sample_seed": args.sample_seed,
+            },
+        }
+
+    project_ids = spec_json.get("project_ids")
+    if not project_ids or len(project_ids) < 2:
+        raise ValueError("At least two input projects must be specified.")
+
+    workspace_id = spec_json.get("workspace_id") or sly.io.env.workspace_id()
+
+    conflict_settings = config.ConflictSettings(
+        image_conflicts=spec_json.get("image_conflicts", config.IMAGE_CONFLICTS[0]),
+        class_conflicts=spec_json.get("class_conflicts", config.CLASS_CONFLICTS[0]),
+        duplicate_images=spec_json.get("duplicate_images", config.DUPLICATE_IMAGES[0]),
+    )
+    if conflict_settings.image_conflicts not in config.IMAGE_CONFLICTS:
+        raise ValueError(f"Unknown image conflicts setting: {conflict_settings.image_conflicts}")
+    if conflict_settings.class_conflicts not in config.CLASS_CONFLICTS:
+        raise ValueError(f"Unknown class conflicts setting: {conflict_settings.class_conflicts}")
+    if conflict_settings.duplicate_images not in config.DUPLICATE_IMAGES:
+        raise ValueError(f"Unknown duplicate images setting: {conflict_settings.duplicate_images}")
+
+    dataset_structure = spec_json.get("dataset_structure", config.DATASET_CONFLICTS[0])
+    if dataset_structure not in config.DATASET_CONFLICTS:
+        raise ValueError(f"Unknown dataset structure: {dataset_structure}")
+
+    image_filter_json = spec_json.get("image_filter") or {}
+    unknown_keys = set(image_filter_json) - set(config.ImageFilter._fields)
+    if unknown_keys:
+        raise ValueError(f"Unknown image filter settings: {', '.join(sorted(unknown_keys))}")
+    image_filter = config.ImageFilter(**image_filter_json)
+    if image_filter.sample_mode not in config.SAMPLE_MODES:
+        raise ValueError(f"Unknown sample mode: {image_filter.sample_mode}")
+
+    return MergeSpec(
+        workspace_id=workspace_id,
+        project_ids=project_ids,
+        conflict_settings=conflict_settings,
+        dataset_structure=dataset_structure,
+        output_project_name=spec_json.get("output_project_name", ""),
+        include_empty_classes=bool(spec_json.get("include_empty_classes", False)),
+        sync_project_id=spec_json.get("sync_project_id"),
+        image_filter=image_filter,
+    )
+
+
+def load_spec_json(path: str) -> dict:
+    """Loads the JSON spec and flattens its nested conflict settings."""
+    with open(path, "r") as f:
+        spec_json = json.load(f)
+
+    unknown_keys = set(spec_json) - SPEC_KEYS
+    if unknown_keys:
+        raise ValueError(f"Unknown keys in the merge spec: {', '.join(sorted(unknown_keys))}")
+
+    conflict_settings = spec_json.pop("conflict_settings", None) or {}
+    unknown_keys = set(conflict_settings) - set(config.ConflictSettings._fields)
+    if unknown_keys:
+        raise ValueError(f"Unknown conflict settings: {', '.join(sorted(unknown_keys))}")
+    repeated_keys = set(conflict_settings) & set(spec_json)
+    if repeated_keys:
+        raise ValueError(
+            f"Conflict settings {', '.join(sorted(repeated_keys))} are set twice in the spec."
+        )
+    spec_json.update(conflict_settings)
+    return spec_json
+
+
+def load_env():
+    if sly.is_development():
+        load_dotenv("local.env")
+        load_dotenv(os.path.expanduser("~/supervisely.env"))
+
+
+def main(args: Optional[List[str]] = None):
+    load_env()
+
+    args = parse_args(args)
+    spec = get_merge_spec(args)
+    if not args.data_dir:
+        raise ValueError("Directory for the merge journal must be specified with --data-dir.")
+
+    api = MergeApi.from_env()
+    output_project_info = merge_projects(api, spec, args.data_dir)
+
+    sly.logger.info(
+        f"Merged {len(spec.project_ids)} projects into project {output_project_info.name} "
+        f"with ID {output_project_info.id}."
+    )
+
+
+if __name__ == "__main__":
+    main()
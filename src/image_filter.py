@@ -0,0 +1,117 @@
+import fnmatch
+import hashlib
+import math
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+import supervisely as sly
+
+import src.config as config
+from src.config import ImageFilter
+from src.meta_cache import MetaCache
+
+
+def is_active(image_filter: ImageFilter) -> bool:
+    """Checks only the fields which filter, e.g. a seed without a sample size changes nothing."""
+    return bool(
+        image_filter.name_pattern
+        or image_filter.class_names
+        or image_filter.tag_names
+        or image_filter.min_labels_count > 0
+        or image_filter.sample_size > 0
+    )
+
+
+def get_tag_names(meta_cache: MetaCache, project_id: int) -> Dict[int, str]:
+    """Returns tag ID -> name of the project, image infos have only the IDs of their tags."""
+    return {tag_id: name for name, tag_id in meta_cache.get_tag_map(project_id).items()}
+
+
+def matches_info(
+    image_filter: ImageFilter, image_info: sly.ImageInfo, tag_names: Dict[int, str]
+) -> bool:
+    """Checks the fields of the image, which are listed without the annotation."""
+    if image_filter.name_pattern and not fnmatch.fnmatch(
+        image_info.name, image_filter.name_pattern
+    ):
+        return False
+    # Images without labels can't have labels of the filtered classes.
+    min_labels_count = max(image_filter.min_labels_count, 1 if image_filter.class_names else 0)
+    if image_info.labels_count < min_labels_count:
+        return False
+    if image_filter.tag_names:
+        image_tag_names = {tag_names.get(tag.get("tagId")) for tag in image_info.tags}
+        if image_tag_names.isdisjoint(image_filter.tag_names):
+            return False
+    return True
+
+
+def matches_ann(image_filter: ImageFilter, ann_json: dict) -> bool:
+    if not image_filter.class_names:
+        return True
+    return any(
+        object_json.get("classTitle") in image_filter.class_names
+        for object_json in ann_json.get("objects", [])
+    )
+
+
+def sample_images(image_filter: ImageFilter, dataset_image_ids: Dict[int, List[int]]) -> Set[int]:
+    """Samples IDs of the images of a single project from input dataset ID -> image IDs.
+
+    Images are ordered by the hash of the seed and the image ID, so the same images are
+    sampled by every run with the same seed, e.g. by a resumed merge.
+    """
+
+    def get_key(image_id: int) -> str:
+        return hashlib.md5(f"{image_filter.sample_seed}:{image_id}".encode()).hexdigest()
+
+    sample_size = image_filter.sample_size
+    if image_filter.sample_mode == "Random":
+        image_ids = [image_id for ids in dataset_image_ids.values() for image_id in ids]
+        return set(sorted(image_ids, key=get_key)[:sample_size])
+
+    # Quotas of the datasets are rounded with the largest remainder method, so they add up
+    # to the sample size.
+    total_count = sum(len(image_ids) for image_ids in dataset_image_ids.values())
+    if total_count <= sample_size:
+        return {image_id for ids in dataset_image_ids.values() for image_id in ids}
+    quotas = {
+        dataset_id: sample_size * len(image_ids) / total_count
+        for dataset_id, image_ids in dataset_image_ids.items()
+    }
+    counts = {dataset_id: math.floor(quota) for dataset_id, quota in quotas.items()}
+    remainders = sorted(quotas, key=lambda dataset_id: counts[dataset_id] - quotas[dataset_id])
+    for dataset_id in remainders[: sample_size - sum(counts.values())]:
+        counts[dataset_id] += 1
+
+    sampled_image_ids = set()
+    for dataset_id, image_ids in dataset_image_ids.items():
+        sampled_image_ids.update(sorted(image_ids, key=get_key)[: counts[dataset_id]])
+    return sampled_image_ids
+
+
+def sample_projects(
+    api: sly.Api,
+    meta_cache: MetaCache,
+    image_filter: ImageFilter,
+    datasets: List[Tuple[int, int]],
+) -> Set[int]:
+    """Lists the (input project ID, input dataset ID) pairs and samples the matching images."""
+    project_images = defaultdict(lambda: defaultdict(list))
+    for project_id, dataset_id in datasets:
+        tag_names = get_tag_names(meta_cache, project_id)
+        for image_infos in api.image.get_list_generator(
+            dataset_id, batch_size=config.UPLOAD_WINDOW_SIZE, force_metadata_for_links=False
+        ):
+            project_images[project_id][dataset_id].extend(
+                image_info.id
+                for image_info in image_infos
+                if matches_info(image_filter, image_info, tag_names)
+            )
+
+    sampled_image_ids = set()
+    for dataset_image_ids in project_images.values():
+        sampled_image_ids.update(sample_images(image_filter, dataset_image_ids))
+
+    sly.logger.info(f"Sampled {len(sampled_image_ids)} images from {len(project_images)} projects.")
+    return sampled_image_ids
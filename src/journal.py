@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import supervisely as sly
+
+import src.config as config
+from src.db import fetch_by_ids
+
+
+class MergeJournal:
+    """Durable journal of a merge, which allows to resume it after a restart.
+
+    The journal is a SQLite file, which records the output project and datasets of the merge
+    and the source -> output image ID pairs. Pairs are recorded right after the images are
+    uploaded and marked as done after their annotations and tags were uploaded too, so a
+    restarted merge skips done images and only finishes annotations and tags of the rest.
+    Adding tags is not idempotent, so every added tag is journaled after its request and is
+    not added again after the restart.
+    """
+
+    def __init__(self, path: str, merge_key: str):
+        self._merge_key = merge_key
+        self._lock = Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, timeout=config.SQLITE_TIMEOUT
+        )
+        with self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS merges (
+                    merge_key TEXT PRIMARY KEY,
+                    output_project_id INTEGER,
+                    finished INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS datasets (
+                    merge_key TEXT NOT NULL,
+                    dataset_key TEXT NOT NULL,
+                    output_dataset_id INTEGER NOT NULL,
+                    PRIMARY KEY (merge_key, dataset_key)
+                );
+                CREATE TABLE IF NOT EXISTS images (
+                    merge_key TEXT NOT NULL,
+                    input_image_id INTEGER NOT NULL,
+                    output_image_id INTEGER NOT NULL,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (merge_key, input_image_id)
+                );
+                CREATE TABLE IF NOT EXISTS image_tags (
+                    merge_key TEXT NOT NULL,
+                    output_image_id INTEGER NOT NULL,
+                    tag_id INTEGER NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (merge_key, output_image_id, tag_id, value)
+                );
+                CREATE TABLE IF NOT EXISTS used_classes (
+                    merge_key TEXT NOT NULL,
+                    class_name TEXT NOT NULL,
+                    PRIMARY KEY (merge_key, class_name)
+                );
+                """
+            )
+
+        sly.logger.debug(f"Opened merge journal {path} for merge {merge_key}.")
+
+    def get_output_project_id(self) -> Optional[int]:
+        """Returns output project ID of the unfinished merge with the same key, if any."""
+        row = self._fetchone(
+            "SELECT output_project_id FROM merges WHERE merge_key = ? AND finished = 0",
+            (self._merge_key,),
+        )
+        return row[0] if row else None
+
+    def set_output_project_id(self, output_project_id: int):
+        # A new output project means the merge starts from scratch.
+        self._execute("DELETE FROM datasets WHERE merge_key = ?", (self._merge_key,))
+        self._execute("DELETE FROM images WHERE merge_key = ?", (self._merge_key,))
+        self._execute("DELETE FROM image_tags WHERE merge_key = ?", (self._merge_key,))
+        self._execute("DELETE FROM used_classes WHERE merge_key = ?", (self._merge_key,))
+        self._execute(
+            "INSERT OR REPLACE INTO merges VALUES (?, ?, 0)",
+            (self._merge_key, output_project_id),
+        )
+
+    def get_output_dataset_id(self, dataset_key: str) -> Optional[int]:
+        row = self._fetchone(
+            "SELECT output_dataset_id FROM datasets WHERE merge_key = ? AND dataset_key = ?",
+            (self._merge_key, dataset_key),
+        )
+        return row[0] if row else None
+
+    def get_dataset_key(self, output_dataset_id: int) -> Optional[str]:
+        row = self._fetchone(
+            "SELECT dataset_key FROM datasets WHERE merge_key = ? AND output_dataset_id = ?",
+            (self._merge_key, output_dataset_id),
+        )
+        return row[0] if row else None
+
+    def add_output_dataset(self, dataset_key: str, output_dataset_id: int):
+        self._execute(
+            "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?)",
+            (self._merge_key, dataset_key, output_dataset_id),
+        )
+
+    def get_images(self, input_image_ids: List[int]) -> Dict[int, Tuple[int, bool]]:
+        """Returns input image ID -> (output image ID, done) for the journaled images."""
+        rows = fetch_by_ids(
+            self._connection,
+            self._lock,
+            "SELECT input_image_id, output_image_id, done FROM images "
+            "WHERE merge_key = ? AND input_image_id IN ({placeholders})",
+            (self._merge_key,),
+            input_image_ids,
+        )
+        return {input_id: (output_id, bool(done)) for input_id, output_id, done in rows}
+
+    def add_images(self, input_image_ids: List[int], output_image_ids: List[int]):
+        self._executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, 0)",
+            [
+                (self._merge_key, input_id, output_id)
+                for input_id, output_id in zip(input_image_ids, output_image_ids)
+            ],
+        )
+
+    def set_images_done(self, input_image_ids: List[int], used_class_names: Iterable[str]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE images SET done = 1 WHERE merge_key = ? AND input_image_id = ?",
+                [(self._merge_key, input_id) for input_id in input_image_ids],
+            )
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO used_classes VALUES (?, ?)",
+                [(self._merge_key, class_name) for class_name in used_class_names],
+            )
+
+    def get_image_tags(self, output_image_ids: List[int]) -> Set[Tuple[int, int, str]]:
+        """Returns (output image ID, tag ID, JSON of the value) of the added tags."""
+        rows = fetch_by_ids(
+            self._connection,
+            self._lock,
+            "SELECT output_image_id, tag_id, value FROM image_tags "
+            "WHERE merge_key = ? AND output_image_id IN ({placeholders})",
+            (self._merge_key,),
+            output_image_ids,
+        )
+        return {tuple(row) for row in rows}
+
+    def add_image_tags(self, output_image_ids: List[int], tag_id: int, value):
+        self._executemany(
+            "INSERT OR IGNORE INTO image_tags VALUES (?, ?, ?, ?)",
+            [
+                (self._merge_key, output_image_id, tag_id, json.dumps(value))
+                for output_image_id in output_image_ids
+            ],
+        )
+
+    def get_used_class_names(self) -> Set[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT class_name FROM used_classes WHERE merge_key = ?", (self._merge_key,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def finish(self):
+        self._execute("UPDATE merges SET finished = 1 WHERE merge_key = ?", (self._merge_key,))
+        self._execute("DELETE FROM images WHERE merge_key = ?", (self._merge_key,))
+        self._execute("DELETE FROM image_tags WHERE merge_key = ?", (self._merge_key,))
+        sly.logger.debug(f"Merge {self._merge_key} was marked as finished in the journal.")
+
+    def _fetchone(self, query: str, params: tuple) -> Optional[tuple]:
+        with self._lock:
+            return self._connection.execute(query, params).fetchone()
+
+    def _execute(self, query: str, params: tuple):
+        with self._lock, self._connection:
+            self._connection.execute(query, params)
+
+    def _executemany(self, query: str, params: List[tuple]):
+        with self._lock, self._connection:
+            self._connection.executemany(query, params)
@@ -0,0 +1,95 @@
+from collections import namedtuple
+from typing import Dict, List, Optional, Tuple
+
+import supervisely as sly
+
+from src.meta_cache import MetaCache
+
+OutputDataset = namedtuple(
+    "OutputDataset",
+    [
+        "key",
+        "name",
+        "parent",
+    ],
+)
+
+LayoutItem = namedtuple(
+    "LayoutItem",
+    [
+        "input_project_id",
+        "input_dataset",
+        "output_dataset",
+    ],
+)
+
+
+def get_output_layout(
+    api: sly.Api, meta_cache: MetaCache, project_ids: List[int], dataset_structure: str
+) -> List[LayoutItem]:
+    """Maps every input dataset to its output dataset without creating anything.
+
+    Output datasets are identified by the key of their source, so the same output dataset
+    can be shared by several input datasets. Nested datasets of any depth are listed with
+    one request per project and are merged as separate datasets.
+    """
+    layout = []
+
+    for input_project_id in project_ids:
+        input_datasets = api.dataset.get_list(input_project_id, recursive=True)
+
+        if dataset_structure == "Merge into one dataset":
+            output_dataset = OutputDataset("merged", "Merged dataset", None)
+            for input_dataset in input_datasets:
+                layout.append(LayoutItem(input_project_id, input_dataset, output_dataset))
+        elif dataset_structure == "Separate dataset for each project":
+            input_project_name = meta_cache.get_project_info(input_project_id).name
+            output_dataset = OutputDataset(f"project_{input_project_id}", input_project_name, None)
+            for input_dataset in input_datasets:
+                layout.append(LayoutItem(input_project_id, input_dataset, output_dataset))
+        elif dataset_structure == "Use hierarchical structure":
+            input_project_name = meta_cache.get_project_info(input_project_id).name
+            parent = OutputDataset(f"project_{input_project_id}", input_project_name, None)
+            for input_dataset, output_dataset in _copy_dataset_tree(input_datasets, parent):
+                layout.append(LayoutItem(input_project_id, input_dataset, output_dataset))
+        elif dataset_structure == "Save original names":
+            for input_dataset, output_dataset in _copy_dataset_tree(input_datasets, None):
+                layout.append(LayoutItem(input_project_id, input_dataset, output_dataset))
+
+    return layout
+
+
+def _copy_dataset_tree(
+    input_datasets: List[sly.DatasetInfo], root: Optional[OutputDataset]
+) -> List[Tuple[sly.DatasetInfo, OutputDataset]]:
+    """Maps the input datasets to the output ones with the same tree under the root."""
+    input_datasets_by_id = {input_dataset.id: input_dataset for input_dataset in input_datasets}
+    output_datasets: Dict[int, OutputDataset] = {}
+
+    def get_output_dataset(input_dataset: sly.DatasetInfo) -> OutputDataset:
+        if input_dataset.id not in output_datasets:
+            parent = root
+            # Children may be listed before their parents.
+            if input_dataset.parent_id in input_datasets_by_id:
+                parent = get_output_dataset(input_datasets_by_id[input_dataset.parent_id])
+            output_datasets[input_dataset.id] = OutputDataset(
+                f"dataset_{input_dataset.id}", input_dataset.name, parent
+            )
+        return output_datasets[input_dataset.id]
+
+    return [(input_dataset, get_output_dataset(input_dataset)) for input_dataset in input_datasets]
+
+
+def get_output_datasets(layout: List[LayoutItem]) -> List[OutputDataset]:
+    """Returns unique output datasets of the layout, parents go before their children."""
+    output_datasets = {}
+
+    def add_output_dataset(output_dataset: OutputDataset):
+        if output_dataset.parent is not None:
+            add_output_dataset(output_dataset.parent)
+        output_datasets.setdefault(output_dataset.key, output_dataset)
+
+    for item in layout:
+        add_output_dataset(item.output_dataset)
+
+    return list(output_datasets.values())
@@ -0,0 +1,966 @@
+import hashlib
+import json
+import os
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from threading import Event, Lock
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import supervisely as sly
+
+import src.config as config
+from src.api_client import MergeApi
+from src.batching import AdaptiveBatchSize
+from src.dedup import DuplicateIndex, index_duplicates
+from src.image_filter import get_tag_names, is_active, matches_ann, matches_info, sample_projects
+from src.journal import MergeJournal
+from src.layout import get_output_datasets, get_output_layout
+from src.meta_cache import MetaCache
+from src.meta_plan import MetaPlan, plan_meta, remove_empty_classes
+from src.name_index import NameIndex
+from src.pipeline import pipeline
+from src.remap import RemapPool, remap_items
+from src.stats import MergeStats
+from src.sync_index import SyncedImage, SyncIndex, is_changed, set_source_dataset
+from src.work_plan import ImageWork
+
+# Merge engine. It doesn't depend on the app widgets and global state, so merges can be
+# started both from the UI and from the headless entry point.
+
+MergeSpec = namedtuple(
+    "MergeSpec",
+    [
+        "workspace_id",
+        "project_ids",
+        "conflict_settings",
+        "dataset_structure",
+        "output_project_name",
+        "include_empty_classes",
+        # ID of the existing output project to sync the input projects into, if any.
+        "sync_project_id",
+        # Filter of the input images, all images are merged if it's None.
+        "image_filter",
+    ],
+    defaults=[None, None],
+)
+
+
+class MergeCancelled(Exception):
+    """Raised by the merge workers at the next batch after the merge was cancelled."""
+
+
+class MergeContext:
+    """State of a single merge, shared by all its workers."""
+
+    def __init__(
+        self, api: sly.Api, spec: MergeSpec, data_dir: str, cancel_event: Optional[Event] = None
+    ):
+        self.api = api
+        self.spec = spec
+        self.data_dir = data_dir
+        self.stats = MergeStats()
+        # Set from another thread to stop the merge, it can be resumed later from the journal.
+        self.cancel_event = cancel_event or Event()
+
+        self.meta_cache = MetaCache(api)
+        self.meta_plan: Optional[MetaPlan] = None
+        self.journal = MergeJournal(
+            os.path.join(data_dir, config.JOURNAL_FILENAME), get_merge_key(spec)
+        )
+
+        self.output_project_id = None
+        self.name_indexes: Dict[int, NameIndex] = {}
+        self.duplicate_index: Optional[DuplicateIndex] = None
+        self.sync_index: Optional[SyncIndex] = None
+
+        self.image_filter = spec.image_filter or config.ImageFilter()
+        # Input project ID -> tag ID -> name, for the filters by image tags.
+        self.input_tag_names: Dict[int, Dict[int, str]] = {}
+        # IDs of the sampled images, None if images are not sampled.
+        self.sampled_image_ids: Optional[Set[int]] = None
+        # Projects, which annotations are copied server-side, because they need no remapping.
+        self.clone_project_ids: Set[int] = set()
+        # Input project ID -> names of the classes with labels, for the copied annotations.
+        self.clone_class_names: Dict[int, Set[str]] = {}
+        # Pool of the annotation remapping processes, None if annotations are remapped in threads.
+        self.remap_pool: Optional[RemapPool] = None
+
+        # Images are added by IDs, so their batches are light, while annotations may be heavy.
+        self.image_batch_size = create_batch_size(self, "image upload", idempotent=False)
+        # The SDK uploads annotations in requests of SDK_BATCH_SIZE, so larger batches don't
+        # save requests and their latency wouldn't be the latency of one request.
+        self.ann_batch_size = create_batch_size(
+            self, "annotation upload", idempotent=True, max_size=config.SDK_BATCH_SIZE
+        )
+        self.ann_copy_batch_size = create_batch_size(self, "annotation copy", idempotent=True)
+
+        # Guards counters which are updated from the merge workers.
+        self.lock = Lock()
+        self.tag_requests_count = 0
+        self.unchanged_images_count = 0
+        self.replaced_images_count = 0
+        self.filtered_images_count = 0
+
+
+def spec_to_json(spec: MergeSpec) -> dict:
+    return {
+        **spec._asdict(),
+        "conflict_settings": spec.conflict_settings._asdict(),
+        "image_filter": spec.image_filter._asdict() if spec.image_filter else None,
+    }
+
+
+def spec_from_json(spec_json: dict) -> MergeSpec:
+    image_filter = spec_json.get("image_filter")
+    return MergeSpec(
+        **{
+            **spec_json,
+            "conflict_settings": config.ConflictSettings(**spec_json["conflict_settings"]),
+            "image_filter": config.ImageFilter(**image_filter) if image_filter else None,
+        }
+    )
+
+
+def create_batch_size(
+    ctx: MergeContext, name: str, idempotent: bool, max_size: int = config.UPLOAD_BATCH_MAX_SIZE
+) -> AdaptiveBatchSize:
+    return AdaptiveBatchSize(
+        name,
+        initial_size=config.SDK_BATCH_SIZE,
+        min_size=config.UPLOAD_BATCH_MIN_SIZE,
+        max_size=min(max_size, config.UPLOAD_BATCH_MAX_SIZE),
+        target_latency=config.UPLOAD_BATCH_TARGET_LATENCY,
+        max_bytes=config.UPLOAD_BATCH_MAX_BYTES,
+        idempotent=idempotent,
+        get_bytes_sent=ctx.stats.get_bytes_sent,
+    )
+
+
+def merge_projects(api: sly.Api, spec: MergeSpec, data_dir: str) -> sly.ProjectInfo:
+    """Runs the whole merge and returns info of the output project."""
+    ctx, jobs = prepare_merge(api, spec, data_dir)
+    progress = sly.Progress("Merging datasets", len(jobs))
+    run_jobs(ctx, jobs, progress.iters_done_report)
+    return finish_merge(ctx)
+
+
+def prepare_merge(
+    api: sly.Api, spec: MergeSpec, data_dir: str, cancel_event: Optional[Event] = None
+) -> Tuple[MergeContext, List[Tuple[int, int, int]]]:
+    """Creates (or resumes) the output project, its meta and datasets.
+
+    Returns merge context and jobs as (input project ID, input dataset ID, output dataset ID).
+    """
+    ctx = MergeContext(api, spec, data_dir, cancel_event)
+    ctx.stats.attach(api)
+
+    jobs = prepare_output(ctx)
+    check_cancelled(ctx)
+    ctx.name_indexes = {
+        output_dataset_id: NameIndex(api, output_dataset_id) for _, _, output_dataset_id in jobs
+    }
+    prepare_indexes(ctx, jobs)
+
+    return ctx, jobs
+
+
+def prepare_output(ctx: MergeContext) -> List[Tuple[int, int, int]]:
+    """Creates (or resumes) the output project, its meta and datasets and returns the jobs.
+
+    These are written to the instance only once per merge, e.g. by the coordinator of the
+    sharded merge, and are shared by all its workers.
+    """
+    create_project(ctx)
+    open_sync_index(ctx)
+
+    sly.logger.debug(
+        f"Dataset structure is set to {ctx.spec.dataset_structure}, starting merging..."
+    )
+
+    update_output_project_meta(ctx)
+    # Classes used by the images, which were uploaded before the restart.
+    ctx.meta_plan.used_class_names.update(ctx.journal.get_used_class_names())
+    set_clone_project_ids(ctx)
+
+    return create_output_datasets(ctx)
+
+
+def open_sync_index(ctx: MergeContext):
+    # Other merges need no index, their output projects are indexed on their first sync.
+    if ctx.spec.sync_project_id is None:
+        return
+    ctx.sync_index = SyncIndex(
+        os.path.join(ctx.data_dir, config.SYNC_INDEX_FILENAME), ctx.output_project_id
+    )
+    if ctx.sync_index.is_empty():
+        with ctx.stats.stage("listing"):
+            ctx.sync_index.load(ctx.api)
+
+
+def clear_sync_index(ctx: MergeContext):
+    """Removes the records of the output project, which were kept by the older versions."""
+    path = os.path.join(ctx.data_dir, config.SYNC_INDEX_FILENAME)
+    if ctx.spec.sync_project_id is None and os.path.exists(path):
+        SyncIndex(path, ctx.output_project_id).clear()
+
+
+def set_clone_project_ids(ctx: MergeContext):
+    if not can_copy_annotations(ctx.spec):
+        return
+
+    ctx.clone_project_ids = {
+        project_id for project_id in ctx.spec.project_ids if ctx.meta_plan.is_identity(project_id)
+    }
+    sly.logger.info(
+        f"Annotations of projects {sorted(ctx.clone_project_ids)} will be copied server-side."
+    )
+    # Copied annotations are not downloaded, so their classes are counted by the instance.
+    if not ctx.spec.include_empty_classes:
+        with ctx.stats.stage("meta fetch"):
+            ctx.clone_class_names = {
+                project_id: get_labeled_class_names(ctx.api, project_id)
+                for project_id in ctx.clone_project_ids
+            }
+
+
+def can_copy_annotations(spec: MergeSpec) -> bool:
+    """Returns True if annotations of the projects, which need no remapping, can be copied."""
+    image_filter = spec.image_filter or config.ImageFilter()
+    # Annotations of the merged duplicates are combined locally and annotations are filtered
+    # by classes after downloading, so they are never copied in these cases.
+    if spec.conflict_settings.duplicate_images == "Merge annotations" or image_filter.class_names:
+        return False
+    # Used classes of the copied annotations are taken from the project stats, which count
+    # labels of all its images, so they are exact only if all the images are merged.
+    return spec.include_empty_classes or (
+        spec.conflict_settings.duplicate_images == "Keep all" and not is_active(image_filter)
+    )
+
+
+def get_labeled_class_names(api: sly.Api, project_id: int) -> Set[str]:
+    stats = api.project.get_stats(project_id)
+    return {
+        item["objectClass"]["name"] for item in stats["objects"]["items"] if item["total"] > 0
+    }
+
+
+def prepare_indexes(ctx: MergeContext, jobs: List[Tuple[int, int, int]]):
+    """Builds the indexes of the input images, which are used by the filters and the dedup."""
+    if ctx.image_filter.tag_names:
+        ctx.input_tag_names = {
+            project_id: get_tag_names(ctx.meta_cache, project_id)
+            for project_id in ctx.spec.project_ids
+        }
+    if ctx.image_filter.sample_size:
+        with ctx.stats.stage("listing"):
+            ctx.sampled_image_ids = sample_projects(
+                ctx.api, ctx.meta_cache, ctx.image_filter, [(job[0], job[1]) for job in jobs]
+            )
+
+    if ctx.spec.conflict_settings.duplicate_images != "Keep all":
+        with ctx.stats.stage("listing"):
+            ctx.duplicate_index = index_duplicates(
+                ctx.api, [(job[0], job[1]) for job in jobs], partial(is_image_included, ctx)
+            )
+
+
+def run_jobs(
+    ctx: MergeContext,
+    jobs: List[Tuple[int, int, int]],
+    progress_cb: Optional[Callable[[int], None]] = None,
+):
+    sly.logger.debug(f"Starting {len(jobs)} dataset jobs with {config.MERGE_WORKERS} workers...")
+
+    with start_remap_pool(ctx), ThreadPoolExecutor(max_workers=config.MERGE_WORKERS) as executor:
+        futures = [executor.submit(upload_dataset, ctx, *job) for job in jobs]
+        try:
+            # Progress is updated only from the calling thread, as jobs are completed.
+            for future in as_completed(futures):
+                future.result()
+                if progress_cb is not None:
+                    progress_cb(1)
+        except BaseException:
+            # Running jobs are stopped at their next batch, e.g. after Ctrl+C in the headless run.
+            ctx.cancel_event.set()
+            for future in futures:
+                future.cancel()
+            raise
+        upload_promoted_images(ctx, jobs)
+
+
+def upload_promoted_images(ctx: MergeContext, jobs: List[Tuple[int, int, int]]):
+    """Merges the duplicates, which are kept instead of the skipped or filtered out images.
+
+    Their jobs may have skipped them as duplicates before, so they are merged after all the jobs,
+    until no more duplicates are promoted.
+    """
+    if ctx.duplicate_index is None:
+        return
+
+    output_dataset_ids = {
+        input_dataset_id: output_dataset_id for _, input_dataset_id, output_dataset_id in jobs
+    }
+    while True:
+        promoted_images = ctx.duplicate_index.pop_promoted()
+        if not promoted_images:
+            return
+        sly.logger.info(f"Merging {len(promoted_images)} duplicates of the dropped images...")
+        dataset_image_ids = defaultdict(list)
+        for input_project_id, image_info in promoted_images:
+            dataset_image_ids[(input_project_id, image_info.dataset_id)].append(image_info.id)
+        for (input_project_id, input_dataset_id), image_ids in dataset_image_ids.items():
+            for batch in sly.batched(image_ids, batch_size=config.UPLOAD_WINDOW_SIZE):
+                upload_dataset(
+                    ctx,
+                    input_project_id,
+                    input_dataset_id,
+                    output_dataset_ids[input_dataset_id],
+                    image_ids=batch,
+                )
+
+
+@contextmanager
+def start_remap_pool(ctx: MergeContext) -> Iterator[None]:
+    """Runs the block with the annotation remapping processes, if they are enabled."""
+    if config.REMAP_PROCESSES <= 0:
+        yield
+        return
+
+    input_metas = {
+        project_id: ctx.meta_cache.get_meta(project_id) for project_id in ctx.spec.project_ids
+    }
+    ctx.remap_pool = RemapPool(ctx.meta_plan, input_metas, config.REMAP_PROCESSES)
+    try:
+        yield
+    finally:
+        ctx.remap_pool.shutdown()
+        ctx.remap_pool = None
+
+
+def check_cancelled(ctx: MergeContext):
+    if ctx.cancel_event.is_set():
+        raise MergeCancelled("Merge was cancelled.")
+
+
+def finish_merge(ctx: MergeContext) -> sly.ProjectInfo:
+    if not ctx.spec.include_empty_classes:
+        sly.logger.info(f"Removing empty classes from output project {ctx.output_project_id}...")
+        with ctx.stats.stage("meta update"):
+            ctx.meta_cache.update_meta(ctx.output_project_id, remove_empty_classes(ctx.meta_plan))
+        sly.logger.info(f"Removed empty classes from output project {ctx.output_project_id}.")
+
+    ctx.journal.finish()
+    clear_sync_index(ctx)
+
+    sly.logger.info(f"Image tags were uploaded with {ctx.tag_requests_count} API requests.")
+    if is_active(ctx.image_filter):
+        sly.logger.info(f"{ctx.filtered_images_count} images were filtered out.")
+    if ctx.spec.sync_project_id is not None:
+        sly.logger.info(
+            f"{ctx.unchanged_images_count} unchanged images were skipped, "
+            f"{ctx.replaced_images_count} changed images were replaced."
+        )
+    sly.logger.info(f"Successfully merged {len(ctx.spec.project_ids)} projects.")
+
+    # Output project info changes with every uploaded image, so it's fetched fresh.
+    ctx.meta_cache.invalidate(ctx.output_project_id)
+    output_project_info = ctx.meta_cache.get_project_info(ctx.output_project_id)
+
+    ctx.stats.detach()
+    if isinstance(ctx.api, MergeApi):
+        ctx.stats.api_latency = ctx.api.latency.to_json()
+    sly.logger.info(f"Merge stats: {ctx.stats.to_lines()}")
+    ctx.stats.save(
+        os.path.join(
+            ctx.data_dir, config.REPORT_FILENAME.format(output_project_id=ctx.output_project_id)
+        )
+    )
+
+    return output_project_info
+
+
+def get_merge_key(spec: MergeSpec) -> str:
+    # Merges with the same inputs and settings share the key, so a restarted merge is resumed.
+    merge_spec = {
+        "workspace_id": spec.workspace_id,
+        "project_ids": spec.project_ids,
+        "conflict_settings": spec.conflict_settings._asdict(),
+        "dataset_structure": spec.dataset_structure,
+        "output_project_name": spec.output_project_name,
+        "sync_project_id": spec.sync_project_id,
+        "image_filter": spec.image_filter._asdict() if spec.image_filter else None,
+    }
+    return hashlib.sha256(json.dumps(merge_spec, sort_keys=True).encode()).hexdigest()
+
+
+def create_output_datasets(ctx: MergeContext) -> List[Tuple[int, int, int]]:
+    """Creates output datasets and returns jobs as (input project ID, input dataset ID,
+    output dataset ID) tuples."""
+    with ctx.stats.stage("listing") as record:
+        layout = get_output_layout(
+            ctx.api, ctx.meta_cache, ctx.spec.project_ids, ctx.spec.dataset_structure
+        )
+        record.items += len(layout)
+
+    output_dataset_ids = {}
+    with ctx.stats.stage("dataset creation") as record:
+        for output_dataset in get_output_datasets(layout):
+            parent_id = None
+            if output_dataset.parent is not None:
+                parent_id = output_dataset_ids[output_dataset.parent.key]
+            output_dataset_ids[output_dataset.key] = create_dataset(
+                ctx, output_dataset.key, output_dataset.name, parent_id=parent_id
+            ).id
+            record.items += 1
+
+    return [
+        (item.input_project_id, item.input_dataset.id, output_dataset_ids[item.output_dataset.key])
+        for item in layout
+    ]
+
+
+def update_output_project_meta(ctx: MergeContext):
+    sly.logger.info("Planning output project meta before uploading...")
+    with ctx.stats.stage("meta fetch") as record:
+        # Synced project keeps its classes and tags, the input ones are planned on top of them.
+        existing_meta = None
+        if ctx.spec.sync_project_id is not None:
+            existing_meta = ctx.meta_cache.get_meta(ctx.output_project_id)
+        ctx.meta_plan = plan_meta(
+            ctx.meta_cache,
+            ctx.spec.project_ids,
+            ctx.spec.conflict_settings.class_conflicts,
+            output_meta=existing_meta,
+        )
+        if existing_meta is not None:
+            ctx.meta_plan.used_class_names.update(
+                obj_class.name for obj_class in existing_meta.obj_classes
+            )
+        record.items += len(ctx.spec.project_ids)
+    with ctx.stats.stage("meta update"):
+        ctx.meta_cache.update_meta(ctx.output_project_id, ctx.meta_plan.output_meta)
+    sly.logger.info("Updated output project meta on instance.")
+
+
+def create_project(ctx: MergeContext):
+    output_project_id = ctx.journal.get_output_project_id()
+    if output_project_id is not None and ctx.api.project.get_info_by_id(output_project_id):
+        ctx.output_project_id = output_project_id
+        sly.logger.info(f"Resuming unfinished merge into output project {output_project_id}.")
+        return
+
+    if ctx.spec.sync_project_id is not None:
+        if ctx.api.project.get_info_by_id(ctx.spec.sync_project_id) is None:
+            raise ValueError(f"Output project with ID {ctx.spec.sync_project_id} doesn't exist.")
+        ctx.output_project_id = ctx.spec.sync_project_id
+        ctx.journal.set_output_project_id(ctx.output_project_id)
+        sly.logger.info(f"Syncing input projects into output project {ctx.output_project_id}.")
+        return
+
+    project_name = ctx.spec.output_project_name
+    if not project_name:
+        project_name = "Merged project"
+
+    ctx.output_project_id = ctx.api.project.create(
+        ctx.spec.workspace_id, project_name, change_name_if_conflict=True
+    ).id
+    ctx.journal.set_output_project_id(ctx.output_project_id)
+
+    sly.logger.info(
+        f"Created output project with ID {ctx.output_project_id} and saved it to the journal."
+    )
+
+
+def upload_dataset(
+    ctx: MergeContext,
+    input_project_id: int,
+    input_dataset_id: int,
+    output_dataset_id: int,
+    image_id_range: Optional[Tuple[int, int]] = None,
+    image_ids: Optional[List[int]] = None,
+):
+    """Merges images of the input dataset, or only the ones with IDs in the inclusive range
+    or in the list."""
+    sly.logger.info(
+        f"Starting uploading dataset with ID {input_dataset_id} to dataset with ID {output_dataset_id}..."
+    )
+
+    # Annotations of the next windows are downloaded and remapped in background threads,
+    # while the current window is uploaded.
+    windows = pipeline(
+        download_windows(ctx, input_project_id, input_dataset_id, image_id_range, image_ids),
+        [partial(update_window, ctx, input_project_id)],
+        queue_size=config.PIPELINE_QUEUE_SIZE,
+    )
+
+    uploaded_images_count = 0
+    for works in windows:
+        uploaded_images_count += upload_window(
+            ctx, input_project_id, input_dataset_id, output_dataset_id, works
+        )
+
+    sly.logger.info(
+        f"Finished uploading dataset with ID {input_dataset_id} to dataset with ID {output_dataset_id}, "
+        f"{uploaded_images_count} images were uploaded."
+    )
+
+
+def is_image_included(
+    ctx: MergeContext, input_project_id: int, input_image_info: sly.ImageInfo
+) -> bool:
+    if ctx.sampled_image_ids is not None and input_image_info.id not in ctx.sampled_image_ids:
+        return False
+    return matches_info(
+        ctx.image_filter, input_image_info, ctx.input_tag_names.get(input_project_id, {})
+    )
+
+
+def skip_unchanged_images(
+    ctx: MergeContext,
+    input_image_infos: List[sly.ImageInfo],
+    journaled_images: Dict[int, Tuple[int, bool]],
+) -> List[sly.ImageInfo]:
+    # Journaled images are synced by this run, their annotations may be not uploaded yet.
+    synced_images = ctx.sync_index.get_images([image_info.id for image_info in input_image_infos])
+    changed_image_infos = [
+        image_info
+        for image_info in input_image_infos
+        if image_info.id in journaled_images
+        or is_changed(image_info, synced_images.get(image_info.id))
+    ]
+    with ctx.lock:
+        ctx.unchanged_images_count += len(input_image_infos) - len(changed_image_infos)
+    return changed_image_infos
+
+
+# Kept image ID -> (input project ID, image info, annotation JSON) of its duplicates.
+Duplicates = Dict[int, List[Tuple[int, sly.ImageInfo, dict]]]
+
+
+def download_windows(
+    ctx: MergeContext,
+    input_project_id: int,
+    input_dataset_id: int,
+    image_id_range: Optional[Tuple[int, int]] = None,
+    image_ids: Optional[List[int]] = None,
+) -> Iterator[Tuple[List[sly.ImageInfo], Optional[List[dict]], Duplicates]]:
+    # Images are listed page by page and annotations are downloaded only for the current page,
+    # so memory usage is bounded by the window size instead of the dataset size.
+    dataset_key = get_dataset_key(input_dataset_id)
+    filters = None
+    if image_id_range is not None:
+        filters = [
+            {"field": "id", "operator": ">=", "value": image_id_range[0]},
+            {"field": "id", "operator": "<=", "value": image_id_range[1]},
+        ]
+    if image_ids is not None:
+        filters = [{"field": "id", "operator": "in", "value": image_ids}]
+
+    for input_image_infos in ctx.stats.iterate(
+        "listing",
+        dataset_key,
+        ctx.api.image.get_list_generator(
+            input_dataset_id,
+            filters=filters,
+            batch_size=config.UPLOAD_WINDOW_SIZE,
+            force_metadata_for_links=True,
+        ),
+    ):
+        check_cancelled(ctx)
+        # Filters, which don't need annotations, are applied before anything is downloaded.
+        if is_active(ctx.image_filter):
+            included_image_infos = [
+                image_info
+                for image_info in input_image_infos
+                if is_image_included(ctx, input_project_id, image_info)
+            ]
+            with ctx.lock:
+                ctx.filtered_images_count += len(input_image_infos) - len(included_image_infos)
+            input_image_infos = included_image_infos
+
+        # Images which were fully merged before the restart are skipped before downloading.
+        journaled_images = ctx.journal.get_images(
+            [image_info.id for image_info in input_image_infos]
+        )
+        if ctx.spec.sync_project_id is not None:
+            input_image_infos = skip_unchanged_images(ctx, input_image_infos, journaled_images)
+        # Duplicates are skipped too, their annotations are merged into the kept images if needed.
+        input_image_infos = [
+            image_info
+            for image_info in input_image_infos
+            if not journaled_images.get(image_info.id, (None, False))[1]
+            and not (ctx.duplicate_index and ctx.duplicate_index.is_duplicate(image_info))
+        ]
+        if not input_image_infos:
+            continue
+
+        if input_project_id in ctx.clone_project_ids:
+            yield input_image_infos, None, {}
+            continue
+
+        image_ids = [image_info.id for image_info in input_image_infos]
+        with ctx.stats.stage("annotation download", dataset_key) as record:
+            ann_jsons = ctx.api.annotation.download_json_batch(input_dataset_id, image_ids)
+            record.items += len(ann_jsons)
+
+            if ctx.image_filter.class_names:
+                window = []
+                for image_info, ann_json in zip(input_image_infos, ann_jsons):
+                    if matches_ann(ctx.image_filter, ann_json):
+                        window.append((image_info, ann_json))
+                    elif ctx.duplicate_index is not None:
+                        ctx.duplicate_index.drop(image_info.id, image_info.hash)
+                with ctx.lock:
+                    ctx.filtered_images_count += len(input_image_infos) - len(window)
+                if not window:
+                    continue
+                input_image_infos = [image_info for image_info, _ in window]
+                ann_jsons = [ann_json for _, ann_json in window]
+
+            duplicates = {}
+            if ctx.spec.conflict_settings.duplicate_images == "Merge annotations":
+                duplicates = download_duplicates(ctx, input_image_infos)
+                record.items += sum(len(items) for items in duplicates.values())
+
+        sly.logger.debug(f"Downloaded window of {len(input_image_infos)} images with annotations.")
+
+        yield input_image_infos, ann_jsons, duplicates
+
+
+def download_duplicates(ctx: MergeContext, input_image_infos: List[sly.ImageInfo]) -> Duplicates:
+    duplicate_images = [
+        (image_info.id, duplicate_project_id, duplicate_info)
+        for image_info in input_image_infos
+        for duplicate_project_id, duplicate_info in ctx.duplicate_index.get_duplicates(
+            image_info.id
+        )
+    ]
+
+    # Duplicates may come from any input dataset, annotations are downloaded by datasets.
+    dataset_images = defaultdict(list)
+    for duplicate_image in duplicate_images:
+        dataset_images[duplicate_image[2].dataset_id].append(duplicate_image)
+
+    duplicates = defaultdict(list)
+    for dataset_id, images in dataset_images.items():
+        ann_jsons = ctx.api.annotation.download_json_batch(
+            dataset_id, [duplicate_info.id for _, _, duplicate_info in images]
+        )
+        for (image_id, duplicate_project_id, duplicate_info), ann_json in zip(images, ann_jsons):
+            duplicates[image_id].append((duplicate_project_id, duplicate_info, ann_json))
+
+    return duplicates
+
+
+def update_window(
+    ctx: MergeContext,
+    input_project_id: int,
+    window: Tuple[List[sly.ImageInfo], Optional[List[dict]], Duplicates],
+) -> List[ImageWork]:
+    input_image_infos, input_ann_jsons, duplicates = window
+    if input_ann_jsons is None:
+        return [ImageWork(image_info, None, []) for image_info in input_image_infos]
+
+    dataset_key = get_dataset_key(input_image_infos[0].dataset_id)
+    with ctx.stats.stage("label remapping", dataset_key) as record:
+        items = [
+            (
+                ann_json,
+                (image_info.height, image_info.width),
+                input_project_id,
+                [
+                    (duplicate_project_id, duplicate_ann_json)
+                    for duplicate_project_id, _, duplicate_ann_json in duplicates.get(
+                        image_info.id, []
+                    )
+                ],
+            )
+            for image_info, ann_json in zip(input_image_infos, input_ann_jsons)
+        ]
+        if ctx.remap_pool is not None:
+            output_anns = ctx.remap_pool.remap(items)
+        else:
+            output_anns = remap_items(ctx.meta_plan, ctx.meta_cache.get_meta, items)
+
+        works = []
+        for image_info, output_ann in zip(input_image_infos, output_anns):
+            duplicate_tags = [
+                (duplicate_project_id, duplicate_info.tags)
+                for duplicate_project_id, duplicate_info, _ in duplicates.get(image_info.id, [])
+            ]
+            works.append(ImageWork(image_info, output_ann, duplicate_tags))
+        record.items += len(works)
+
+    sly.logger.debug(
+        f"Successfully updated annotations for {len(works)} images and prepared them for upload."
+    )
+
+    return works
+
+
+def upload_window(
+    ctx: MergeContext,
+    input_project_id: int,
+    input_dataset_id: int,
+    output_dataset_id: int,
+    works: List[ImageWork],
+) -> int:
+    # Images which were uploaded before the restart, but have no annotations or tags yet,
+    # are not uploaded again.
+    journaled_images = ctx.journal.get_images([work.input_image_id for work in works])
+    new_works = []
+    for work in works:
+        if work.input_image_id in journaled_images:
+            work.output_image_id = journaled_images[work.input_image_id][0]
+        else:
+            new_works.append(work)
+
+    dataset_key = get_dataset_key(input_dataset_id)
+
+    # Changed images replace their previous versions and take their names.
+    replaced_image_names = {}
+    if ctx.spec.sync_project_id is not None:
+        with ctx.stats.stage("image upload", dataset_key):
+            replaced_image_names = remove_replaced_images(
+                ctx, output_dataset_id, [work.input_image_id for work in new_works]
+            )
+
+    # Names are reserved in the output dataset index before upload, so several jobs can
+    # upload to the same output dataset at the same time.
+    reserved_works = [work for work in new_works if work.input_image_id not in replaced_image_names]
+    with ctx.stats.stage("listing", dataset_key):
+        reserved_image_names = ctx.name_indexes[output_dataset_id].reserve(
+            [work.name for work in reserved_works], ctx.spec.conflict_settings.image_conflicts
+        )
+    for work, output_image_name in zip(reserved_works, reserved_image_names):
+        work.output_image_name = output_image_name
+    for work in new_works:
+        if work.input_image_id in replaced_image_names:
+            work.output_image_name = replaced_image_names[work.input_image_id]
+
+    # Images with no output name are skipped, their duplicates are kept instead.
+    upload_works = [work for work in new_works if work.output_image_name is not None]
+    if ctx.duplicate_index is not None:
+        for work in new_works:
+            if work.output_image_name is None:
+                ctx.duplicate_index.drop(work.input_image_id, work.hash)
+    # Output images record their dataset, so the sync finds it, if the index is rebuilt.
+    output_dataset_key = ctx.journal.get_dataset_key(output_dataset_id)
+    for work in upload_works:
+        set_source_dataset(work.meta, output_dataset_key)
+
+    def upload_images_batch(batch: List[ImageWork]):
+        # Uploaded images are journaled, so the merge is stopped only between the batches.
+        check_cancelled(ctx)
+        # The whole batch is sent in one request, its size is controlled by the adaptive size.
+        # The records are passed as infos, otherwise the SDK fetches the infos of the input images.
+        uploaded_image_infos = ctx.api.image.upload_ids(
+            output_dataset_id,
+            ids=[work.input_image_id for work in batch],
+            names=[work.output_image_name for work in batch],
+            metas=[work.meta for work in batch],
+            batch_size=len(batch),
+            infos=batch,
+        )
+        for work, image_info in zip(batch, uploaded_image_infos):
+            work.output_image_id = image_info.id
+        ctx.journal.add_images(
+            [work.input_image_id for work in batch], [work.output_image_id for work in batch]
+        )
+        if ctx.sync_index is not None:
+            ctx.sync_index.add_images(
+                [
+                    SyncedImage(
+                        work.input_image_id,
+                        work.output_image_id,
+                        output_dataset_id,
+                        work.output_image_name,
+                        work.updated_at,
+                    )
+                    for work in batch
+                ]
+            )
+        ctx.stats.add_items(len(batch))
+
+    def upload_anns_batch(batch: List[ImageWork]):
+        ctx.api.annotation.upload_jsons(
+            [work.output_image_id for work in batch], [work.ann for work in batch]
+        )
+        ctx.stats.add_items(len(batch))
+
+        sly.logger.debug(f"Successfully uploaded batch of {len(batch)} images with annotations.")
+
+    def copy_anns_batch(batch: List[ImageWork]):
+        # Classes and tags are matched by names in the output project, image tags are copied too.
+        ctx.api.annotation.copy_batch_by_ids(
+            [work.input_image_id for work in batch],
+            [work.output_image_id for work in batch],
+            batch_size=len(batch),
+        )
+        ctx.stats.add_items(len(batch))
+
+    with ctx.stats.stage("image upload", dataset_key):
+        ctx.image_batch_size.upload(upload_works, upload_images_batch)
+
+    processed_works = [work for work in works if work.output_image_id is not None]
+    cloned_works = [work for work in processed_works if work.ann is None]
+    remapped_works = [work for work in processed_works if work.ann is not None]
+
+    with ctx.stats.stage("annotation upload", dataset_key):
+        ctx.ann_batch_size.upload(remapped_works, upload_anns_batch)
+        ctx.ann_copy_batch_size.upload(cloned_works, copy_anns_batch)
+
+    with ctx.stats.stage("tag upload", dataset_key):
+        tagged_images = []
+        for work in remapped_works:
+            tagged_images.append((input_project_id, work.tags, work.output_image_id))
+            # Tags of the duplicates are merged into the kept image with their annotations.
+            for duplicate_project_id, duplicate_tags in work.duplicate_tags:
+                tagged_images.append((duplicate_project_id, duplicate_tags, work.output_image_id))
+        tag_requests_count = upload_image_tags(ctx, tagged_images)
+    with ctx.lock:
+        ctx.tag_requests_count += tag_requests_count
+    sly.logger.debug(f"Uploaded image tags with {tag_requests_count} API requests.")
+
+    window_class_names = set()
+    for work in remapped_works:
+        window_class_names.update(object_json["classTitle"] for object_json in work.ann["objects"])
+    # Copied annotations are not downloaded, classes of their project were counted before.
+    if any(work.labels_count for work in cloned_works):
+        window_class_names.update(ctx.clone_class_names.get(input_project_id, []))
+    ctx.meta_plan.used_class_names.update(window_class_names)
+    ctx.journal.set_images_done(
+        [work.input_image_id for work in processed_works], window_class_names
+    )
+
+    return len(upload_works)
+
+
+def remove_replaced_images(
+    ctx: MergeContext, output_dataset_id: int, input_image_ids: List[int]
+) -> Dict[int, str]:
+    """Removes previous versions of the synced images from the output project.
+
+    Returns input image ID -> name of the removed image, if it was in the same output dataset.
+    """
+    synced_images = ctx.sync_index.get_images(input_image_ids)
+    if not synced_images:
+        return {}
+
+    ctx.api.image.remove_batch(
+        [synced_image.output_image_id for synced_image in synced_images.values()]
+    )
+    ctx.sync_index.remove_images(list(synced_images))
+    with ctx.lock:
+        ctx.replaced_images_count += len(synced_images)
+    sly.logger.debug(f"Removed {len(synced_images)} previous versions of the changed images.")
+
+    return {
+        input_image_id: synced_image.output_image_name
+        for input_image_id, synced_image in synced_images.items()
+        if synced_image.output_dataset_id == output_dataset_id
+    }
+
+
+def upload_image_tags(ctx: MergeContext, tagged_images: List[Tuple[int, List[dict], int]]) -> int:
+    """Adds tags of the (input project ID, input image tags, output image ID) images."""
+    output_tag_map = ctx.meta_cache.get_tag_map(ctx.output_project_id)
+
+    # Images are grouped by (tag ID, value), so each group is added with bulk requests.
+    # Output image IDs are dict keys, so the same tag is not added to a merged image twice.
+    to_upload = defaultdict(dict)
+    reversed_input_tag_maps = {}
+
+    for input_project_id, input_tags, output_image_id in tagged_images:
+        if input_project_id not in reversed_input_tag_maps:
+            input_tag_map = ctx.meta_cache.get_tag_map(input_project_id)
+            reversed_input_tag_maps[input_project_id] = {v: k for k, v in input_tag_map.items()}
+        reversed_input_tag_map = reversed_input_tag_maps[input_project_id]
+        tag_names = ctx.meta_plan.tag_names[input_project_id]
+
+        input_tag_ids = [tag.get("tagId") for tag in input_tags]
+        input_tag_values = [tag.get("value") for tag in input_tags]
+        input_tag_names = [reversed_input_tag_map[tag_id] for tag_id in input_tag_ids]
+
+        output_tag_ids = [
+            output_tag_map[tag_names[tag_name]] if tag_names[tag_name] else None
+            for tag_name in input_tag_names
+        ]
+
+        for tag_id, tag_value in zip(output_tag_ids, input_tag_values):
+            if tag_id is None:
+                continue
+            to_upload[(tag_id, tag_value)][output_image_id] = None
+
+    # Tags, which were added before the restart, are not added again.
+    added_tags = ctx.journal.get_image_tags(
+        list({image_id for image_ids in to_upload.values() for image_id in image_ids})
+    )
+
+    requests_count = 0
+    for (tag_id, tag_value), image_ids in to_upload.items():
+        value_json = json.dumps(tag_value)
+        image_ids = [
+            image_id for image_id in image_ids if (image_id, tag_id, value_json) not in added_tags
+        ]
+        ctx.stats.add_items(len(image_ids))
+        # Every request is journaled, so at most one request is repeated after the restart.
+        for batched_image_ids in sly.batched(image_ids, batch_size=config.TAG_BATCH_SIZE):
+            ctx.api.image.add_tag_batch(
+                batched_image_ids, tag_id, tag_value, batch_size=config.TAG_BATCH_SIZE
+            )
+            ctx.journal.add_image_tags(batched_image_ids, tag_id, tag_value)
+            requests_count += 1
+
+    return requests_count
+
+
+def get_dataset_key(input_dataset_id: int) -> str:
+    return f"dataset_{input_dataset_id}"
+
+
+def create_dataset(
+    ctx: MergeContext, dataset_key: str, dataset_name: str, parent_id: int = None
+) -> sly.DatasetInfo:
+    # Datasets are journaled by the key of their source, so a resumed merge reuses them.
+    output_dataset_id = ctx.journal.get_output_dataset_id(dataset_key)
+    if output_dataset_id is not None:
+        output_dataset = ctx.api.dataset.get_info_by_id(output_dataset_id)
+        if output_dataset is not None:
+            return output_dataset
+
+    # Synced project already has the datasets, which were created by the previous merges.
+    # They are found by the keys of their sources, because datasets with the same names
+    # were renamed, e.g. "ds_0" of the second project was created as "ds_0_001".
+    if ctx.spec.sync_project_id is not None:
+        output_dataset = None
+        output_dataset_id = ctx.sync_index.get_output_dataset_id(dataset_key)
+        if output_dataset_id is not None:
+            output_dataset = ctx.api.dataset.get_info_by_id(output_dataset_id)
+        if output_dataset is None:
+            # Datasets of the projects merged by the older versions are only found by names,
+            # unless the dataset with the name belongs to another source.
+            output_dataset = ctx.api.dataset.get_info_by_name(
+                ctx.output_project_id, dataset_name, parent_id=parent_id
+            )
+            if output_dataset is not None and ctx.sync_index.get_dataset_key(
+                output_dataset.id
+            ) not in [None, dataset_key]:
+                output_dataset = None
+        if output_dataset is not None:
+            ctx.journal.add_output_dataset(dataset_key, output_dataset.id)
+            ctx.sync_index.add_output_dataset(dataset_key, output_dataset.id)
+            return output_dataset
+
+    output_dataset = ctx.api.dataset.create(
+        ctx.output_project_id,
+        dataset_name,
+        change_name_if_conflict=True,
+        parent_id=parent_id,
+    )
+    ctx.journal.add_output_dataset(dataset_key, output_dataset.id)
+    if ctx.sync_index is not None:
+        ctx.sync_index.add_output_dataset(dataset_key, output_dataset.id)
+    return output_dataset
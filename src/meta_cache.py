@@ -0,0 +1,57 @@
+from threading import Lock
+from typing import Dict
+
+import supervisely as sly
+
+
+class MetaCache:
+    """Merge-scoped cache for project metas, tag name maps and project infos.
+
+    Every value is fetched from the instance at most once per merge. The output project
+    meta must be written through `update_meta`, so the cached values never go stale.
+    The cache is shared by the merge workers, so all access is guarded by a lock.
+    """
+
+    def __init__(self, api: sly.Api):
+        self._api = api
+        self._metas: Dict[int, sly.ProjectMeta] = {}
+        self._tag_maps: Dict[int, Dict[str, int]] = {}
+        self._project_infos: Dict[int, sly.ProjectInfo] = {}
+        self._lock = Lock()
+
+    def get_meta(self, project_id: int) -> sly.ProjectMeta:
+        with self._lock:
+            if project_id not in self._metas:
+                sly.logger.debug(f"Meta for project {project_id} is not cached, fetching it...")
+                self._metas[project_id] = sly.ProjectMeta.from_json(
+                    self._api.project.get_meta(project_id)
+                )
+            return self._metas[project_id]
+
+    def get_tag_map(self, project_id: int) -> Dict[str, int]:
+        with self._lock:
+            if project_id not in self._tag_maps:
+                sly.logger.debug(f"Tag map for project {project_id} is not cached, fetching it...")
+                self._tag_maps[project_id] = self._api.image.tag.get_name_to_id_map(project_id)
+            return self._tag_maps[project_id]
+
+    def get_project_info(self, project_id: int) -> sly.ProjectInfo:
+        with self._lock:
+            if project_id not in self._project_infos:
+                self._project_infos[project_id] = self._api.project.get_info_by_id(project_id)
+            return self._project_infos[project_id]
+
+    def update_meta(self, project_id: int, meta: sly.ProjectMeta) -> sly.ProjectMeta:
+        with self._lock:
+            self._api.project.update_meta(project_id, meta)
+        self.invalidate(project_id)
+        sly.logger.debug(f"Updated meta for project {project_id}, cache was invalidated.")
+        return meta
+
+    def invalidate(self, project_id: int):
+        # Tag and class IDs are assigned by the instance, so the tag map and the
+        # project info (items count, updated at) are dropped together with the meta.
+        with self._lock:
+            self._metas.pop(project_id, None)
+            self._tag_maps.pop(project_id, None)
+            self._project_infos.pop(project_id, None)
@@ -0,0 +1,178 @@
+from typing import Dict, List, Optional, Set, Tuple
+
+import supervisely as sly
+
+from src.meta_cache import MetaCache
+
+
+class MetaPlan:
+    """Output project meta and rename tables, resolved before any image is uploaded.
+
+    `class_names` and `tag_names` map a project ID to a dict of source name -> output name,
+    where output name is None if the class or tag must be dropped under the "Skip" policy.
+    `obj_classes` and `tag_metas` are the same tables compiled to the output objects, so
+    labels are remapped with a single dict lookup.
+    """
+
+    def __init__(
+        self,
+        output_meta: sly.ProjectMeta,
+        class_names: Dict[int, Dict[str, Optional[str]]],
+        tag_names: Dict[int, Dict[str, Optional[str]]],
+    ):
+        self.output_meta = output_meta
+        self.class_names = class_names
+        self.tag_names = tag_names
+        self.used_class_names: Set[str] = set()
+
+        self.obj_classes: Dict[int, Dict[str, Optional[sly.ObjClass]]] = {
+            project_id: {
+                name: output_meta.get_obj_class(output_name) if output_name else None
+                for name, output_name in names.items()
+            }
+            for project_id, names in class_names.items()
+        }
+        self.tag_metas: Dict[int, Dict[str, Optional[sly.TagMeta]]] = {
+            project_id: {
+                name: output_meta.get_tag_meta(output_name) if output_name else None
+                for name, output_name in names.items()
+            }
+            for project_id, names in tag_names.items()
+        }
+
+    def to_json(self) -> dict:
+        return {
+            "output_meta": self.output_meta.to_json(),
+            "class_names": self.class_names,
+            "tag_names": self.tag_names,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "MetaPlan":
+        # Project IDs are the keys of the tables, JSON keeps them as strings.
+        return cls(
+            sly.ProjectMeta.from_json(data["output_meta"]),
+            {int(project_id): names for project_id, names in data["class_names"].items()},
+            {int(project_id): names for project_id, names in data["tag_names"].items()},
+        )
+
+    def is_identity(self, project_id: int) -> bool:
+        """Checks that classes and tags of the project are merged without renames and skips."""
+        return all(
+            name == output_name for name, output_name in self.class_names[project_id].items()
+        ) and all(name == output_name for name, output_name in self.tag_names[project_id].items())
+
+
+def plan_meta(
+    meta_cache: MetaCache,
+    project_ids: List[int],
+    class_conflicts: str,
+    output_meta: Optional[sly.ProjectMeta] = None,
+) -> MetaPlan:
+    """Plans the output meta from scratch or on top of the existing `output_meta`."""
+    if output_meta is None:
+        output_meta = sly.ProjectMeta()
+    class_names = {}
+    tag_names = {}
+
+    for project_id in project_ids:
+        input_meta = meta_cache.get_meta(project_id)
+
+        class_names[project_id] = {}
+        for obj_class in input_meta.obj_classes:
+            output_meta, output_name = _resolve_obj_class(output_meta, obj_class, class_conflicts)
+            class_names[project_id][obj_class.name] = output_name
+
+        tag_names[project_id] = {}
+        for tag_meta in input_meta.tag_metas:
+            output_meta, output_name = _resolve_tag_meta(output_meta, tag_meta, class_conflicts)
+            tag_names[project_id][tag_meta.name] = output_name
+
+    sly.logger.info(
+        f"Planned output project meta with {len(output_meta.obj_classes)} object classes "
+        f"and {len(output_meta.tag_metas)} tag metas from {len(project_ids)} projects."
+    )
+
+    return MetaPlan(output_meta, class_names, tag_names)
+
+
+def remove_empty_classes(plan: MetaPlan) -> sly.ProjectMeta:
+    empty_class_names = [
+        obj_class.name
+        for obj_class in plan.output_meta.obj_classes
+        if obj_class.name not in plan.used_class_names
+    ]
+    sly.logger.debug(f"Removing {len(empty_class_names)} empty object classes from output meta.")
+    return plan.output_meta.delete_obj_classes(empty_class_names)
+
+
+def _resolve_obj_class(
+    output_meta: sly.ProjectMeta, obj_class: sly.ObjClass, class_conflicts: str
+) -> Tuple[sly.ProjectMeta, Optional[str]]:
+    existing_obj_class = output_meta.get_obj_class(obj_class.name)
+    if existing_obj_class is None:
+        return output_meta.add_obj_class(obj_class), obj_class.name
+
+    if existing_obj_class.geometry_type == obj_class.geometry_type:
+        return output_meta, obj_class.name
+
+    sly.logger.debug(
+        f"Output project meta already contains object class with name {obj_class.name}, "
+        f"existing geometry type: {existing_obj_class.geometry_type}, new geometry type: "
+        f"{obj_class.geometry_type}."
+    )
+
+    if class_conflicts == "Skip":
+        sly.logger.debug(
+            f"Conflict resolution is set to 'Skip', labels of object class {obj_class.name} will be skipped."
+        )
+        return output_meta, None
+
+    new_name = f"{obj_class.name}_{obj_class.geometry_type.geometry_name()}"
+    sly.logger.debug(
+        f"Conflict resolution is set to 'Rename', object class {obj_class.name} will be renamed to {new_name}."
+    )
+
+    existing_obj_class = output_meta.get_obj_class(new_name)
+    if existing_obj_class is None:
+        return output_meta.add_obj_class(obj_class.clone(name=new_name)), new_name
+    if existing_obj_class.geometry_type == obj_class.geometry_type:
+        return output_meta, new_name
+
+    sly.logger.warning(
+        f"Can not rename object class {obj_class.name} to {new_name}, the name is already taken "
+        "by the class with another geometry type. Its labels will be skipped."
+    )
+    return output_meta, None
+
+
+def _resolve_tag_meta(
+    output_meta: sly.ProjectMeta, tag_meta: sly.TagMeta, class_conflicts: str
+) -> Tuple[sly.ProjectMeta, Optional[str]]:
+    existing_tag_meta = output_meta.get_tag_meta(tag_meta.name)
+    if existing_tag_meta is None:
+        return output_meta.add_tag_meta(tag_meta), tag_meta.name
+
+    if existing_tag_meta.value_type == tag_meta.value_type:
+        return output_meta, tag_meta.name
+
+    sly.logger.debug(
+        f"Output project meta already contains tag meta with name {tag_meta.name}, "
+        f"existing value type: {existing_tag_meta.value_type}, new value type: {tag_meta.value_type}."
+    )
+
+    if class_conflicts == "Skip":
+        return output_meta, None
+
+    new_name = f"{tag_meta.name}_{tag_meta.value_type}"
+    existing_tag_meta = output_meta.get_tag_meta(new_name)
+    if existing_tag_meta is None:
+        return output_meta.add_tag_meta(tag_meta.clone(name=new_name)), new_name
+    if existing_tag_meta.value_type == tag_meta.value_type:
+        return output_meta, new_name
+
+    sly.logger.warning(
+        f"Can not rename tag meta {tag_meta.name} to {new_name}, the name is already taken "
+        "by the tag meta with another value type. Its tags will be skipped."
+    )
+    return output_meta, None
@@ -0,0 +1,86 @@
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Set
+
+import supervisely as sly
+from supervisely.io.fs import get_file_ext, get_file_name
+
+import src.config as config
+
+
+class NameIndex:
+    """Set of image names in the output dataset, loaded once and updated locally.
+
+    Names are reserved before the images are uploaded, so several workers can upload to
+    the same dataset without picking the same name. Free names are generated locally in the
+    same format as `api.image.get_free_name`, which puts the suffix before the extension:
+    `name_001.ext`, `name_002.ext`, ... (unlike `get_free_name` of projects and datasets).
+    If `names` are given, the dataset is not listed, e.g. for datasets which don't exist yet.
+    """
+
+    def __init__(
+        self, api: sly.Api, dataset_id: Optional[int], names: Optional[Set[str]] = None
+    ):
+        self._api = api
+        self._dataset_id = dataset_id
+        self._names = names
+        self._next_suffixes: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def reserve(self, names: List[str], image_conflicts: str) -> List[Optional[str]]:
+        """Returns output names for the given names, None if the image must be skipped."""
+        with self._lock:
+            if self._names is None:
+                # Infos are listed page by page, so only the names are kept in memory.
+                self._names = {
+                    image_info.name
+                    for image_infos in self._api.image.get_list_generator(
+                        self._dataset_id,
+                        batch_size=config.UPLOAD_WINDOW_SIZE,
+                        force_metadata_for_links=False,
+                    )
+                    for image_info in image_infos
+                }
+                sly.logger.debug(
+                    f"Loaded {len(self._names)} image names of output dataset {self._dataset_id}."
+                )
+
+            output_names = []
+            for name in names:
+                if name in self._names:
+                    sly.logger.debug(f"Image with name {name} already exists in output dataset.")
+
+                    if image_conflicts == "Skip":
+                        sly.logger.debug(
+                            f"Conflict resolution is set to 'Skip', skipping image with name {name}..."
+                        )
+                        output_names.append(None)
+                        continue
+                    elif image_conflicts == "Rename":
+                        new_name = get_free_name(
+                            name, self._names.__contains__, self._next_suffixes
+                        )
+                        sly.logger.debug(
+                            f"Conflict resolution is set to 'Rename', the image {name} was renamed to {new_name}."
+                        )
+                        name = new_name
+
+                self._names.add(name)
+                output_names.append(name)
+
+            return output_names
+
+
+def get_free_name(name: str, is_taken: Callable[[str], bool], next_suffixes: Dict[str, int]) -> str:
+    """Returns the first free name with a suffix, `next_suffixes` are updated for the name."""
+    name_without_ext = get_file_name(name)
+    ext = get_file_ext(name)
+
+    # Suffixes which were already tried for this name are never checked again.
+    suffix = next_suffixes.get(name, 1)
+    free_name = f"{name_without_ext}_{suffix:03d}{ext}"
+    while is_taken(free_name):
+        suffix += 1
+        free_name = f"{name_without_ext}_{suffix:03d}{ext}"
+
+    next_suffixes[name] = suffix + 1
+    return free_name
@@ -0,0 +1,87 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Any, Callable, Iterable, Iterator, List
+
+import supervisely as sly
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+def pipeline(
+    source: Iterable, stages: List[Callable[[Any], Any]], queue_size: int = 2
+) -> Iterator[Any]:
+    """Runs the source and every stage in its own thread, connected with bounded queues.
+
+    Results of the last stage are yielded in the source order. While the caller handles
+    one item, the stages already work on the next ones, but no more than `queue_size`
+    items wait between two stages. Exceptions of any stage are re-raised in the caller,
+    and all the threads are stopped if the caller stops iterating.
+    """
+    stop = Event()
+    queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def put(queue: Queue, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(queue: Queue) -> Any:
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return _DONE
+
+    def run_source(output_queue: Queue):
+        try:
+            for item in source:
+                if not put(output_queue, item):
+                    return
+        except Exception as e:
+            put(output_queue, _Failure(e))
+            return
+        put(output_queue, _DONE)
+
+    def run_stage(stage: Callable[[Any], Any], input_queue: Queue, output_queue: Queue):
+        while True:
+            item = get(input_queue)
+            if item is _DONE or isinstance(item, _Failure):
+                put(output_queue, item)
+                return
+            try:
+                result = stage(item)
+            except Exception as e:
+                put(output_queue, _Failure(e))
+                return
+            if not put(output_queue, result):
+                return
+
+    threads = [Thread(target=run_source, args=(queues[0],), daemon=True)]
+    for stage, input_queue, output_queue in zip(stages, queues, queues[1:]):
+        threads.append(
+            Thread(target=run_stage, args=(stage, input_queue, output_queue), daemon=True)
+        )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+        sly.logger.debug("Pipeline was finished, stopping its threads.")
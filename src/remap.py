@@ -0,0 +1,221 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from typing import Callable, Dict, List, Optional, Tuple
+
+import supervisely as sly
+
+import src.config as config
+from src.meta_plan import MetaPlan
+
+# Remapping input of a single image: (annotation JSON, image size, input project ID,
+# [(input project ID, annotation JSON)] of its duplicates, which are merged into the image).
+RemapItem = Tuple[dict, Tuple[int, int], int, List[Tuple[int, dict]]]
+
+
+def remap_items(
+    plan: MetaPlan, get_input_meta: Callable[[int], sly.ProjectMeta], items: List[RemapItem]
+) -> List[dict]:
+    """Returns output annotation JSONs in the order of the items."""
+    output_anns = []
+    for ann_json, img_size, input_project_id, duplicates in items:
+        output_ann = update_annotation_json(
+            plan, get_input_meta, ann_json, img_size, input_project_id
+        )
+        # Duplicates have the same content, so their objects fit the kept image.
+        for duplicate_project_id, duplicate_ann_json in duplicates:
+            output_ann["objects"].extend(
+                update_annotation_json(
+                    plan, get_input_meta, duplicate_ann_json, img_size, duplicate_project_id
+                )["objects"]
+            )
+        output_anns.append(output_ann)
+    return output_anns
+
+
+class RemapPool:
+    """Process pool, which remaps annotations of the windows on all CPU cores.
+
+    Annotations of the windows are remapped in the dataset threads, so geometry conversions
+    of bitmap- and polygon-heavy projects are limited by a single core because of the GIL.
+    Workers get the input metas and the meta plan once, when they are started, and only
+    annotation JSONs are sent with every chunk.
+    """
+
+    def __init__(self, plan: MetaPlan, input_metas: Dict[int, sly.ProjectMeta], processes: int):
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=get_mp_context(),
+            initializer=_init_worker,
+            initargs=(
+                plan.output_meta.to_json(),
+                plan.class_names,
+                plan.tag_names,
+                {project_id: meta.to_json() for project_id, meta in input_metas.items()},
+            ),
+        )
+        sly.logger.info(f"Started {processes} processes for annotation remapping.")
+
+    def remap(self, items: List[RemapItem]) -> List[dict]:
+        chunks = [
+            items[start:start + config.REMAP_CHUNK_SIZE]
+            for start in range(0, len(items), config.REMAP_CHUNK_SIZE)
+        ]
+        # Results of the map are returned in the order of the chunks, so they match the images.
+        return [
+            output_ann
+            for output_anns in self._executor.map(_remap_chunk, chunks)
+            for output_ann in output_anns
+        ]
+
+    def shutdown(self):
+        self._executor.shutdown()
+        sly.logger.debug("Annotation remapping processes were stopped.")
+
+
+def get_mp_context():
+    # The merge is started from a process with running threads (the app server, the API
+    # sessions), which can't be forked safely. Workers are forked from the fork server
+    # instead, which imports the SDK once, or spawned where it's not available.
+    if "forkserver" in get_all_start_methods():
+        mp_context = get_context("forkserver")
+        mp_context.set_forkserver_preload([__name__])
+        return mp_context
+    return get_context("spawn")
+
+
+# State of the pool worker process, set once by the initializer.
+_worker_plan: Optional[MetaPlan] = None
+_worker_input_metas: Dict[int, sly.ProjectMeta] = {}
+
+
+def _init_worker(
+    output_meta_json: dict,
+    class_names: Dict[int, Dict[str, Optional[str]]],
+    tag_names: Dict[int, Dict[str, Optional[str]]],
+    input_meta_jsons: Dict[int, dict],
+):
+    global _worker_plan, _worker_input_metas
+    _worker_plan = MetaPlan(sly.ProjectMeta.from_json(output_meta_json), class_names, tag_names)
+    _worker_input_metas = {
+        project_id: sly.ProjectMeta.from_json(meta_json)
+        for project_id, meta_json in input_meta_jsons.items()
+    }
+
+
+def _remap_chunk(items: List[RemapItem]) -> List[dict]:
+    return remap_items(_worker_plan, _worker_input_metas.__getitem__, items)
+
+
+def update_annotation_json(
+    plan: MetaPlan,
+    get_input_meta: Callable[[int], sly.ProjectMeta],
+    input_ann_json: dict,
+    img_size: Tuple[int, int],
+    input_project_id: int,
+) -> dict:
+    """Remaps classes and tags of the annotation without parsing its geometries.
+
+    Annotation is parsed only if a geometry doesn't fit its output class and must be converted.
+    """
+    obj_classes = plan.obj_classes[input_project_id]
+    tag_metas = plan.tag_metas[input_project_id]
+
+    output_objects = []
+    for object_json in input_ann_json.get("objects", []):
+        output_obj_class = obj_classes.get(object_json.get("classTitle"))
+        if output_obj_class is None:
+            continue
+        if not geometry_fits(output_obj_class, object_json.get("geometryType")):
+            input_ann = sly.Annotation.from_json(input_ann_json, get_input_meta(input_project_id))
+            return update_annotation(plan, input_ann, img_size, input_project_id).to_json()
+        output_objects.append(update_object_json(object_json, output_obj_class, tag_metas))
+
+    # Image tags are added separately, so only the objects are kept like in update_annotation.
+    return {
+        "description": "",
+        "size": {"height": img_size[0], "width": img_size[1]},
+        "tags": [],
+        "objects": output_objects,
+    }
+
+
+def update_object_json(
+    input_object_json: dict,
+    output_obj_class: sly.ObjClass,
+    tag_metas: Dict[str, Optional[sly.TagMeta]],
+) -> dict:
+    # IDs of the objects, classes and tags belong to the input project, so they are dropped.
+    # Geometry is shared with the input JSON, it's not modified.
+    output_object_json = {
+        key: value for key, value in input_object_json.items() if key not in ["id", "classId"]
+    }
+    output_object_json["classTitle"] = output_obj_class.name
+
+    output_tags = []
+    for tag_json in input_object_json.get("tags", []):
+        output_tag_meta = tag_metas.get(tag_json.get("name"))
+        if output_tag_meta is None:
+            continue
+        output_tag_json = {
+            key: value for key, value in tag_json.items() if key not in ["id", "tagId"]
+        }
+        output_tag_json["name"] = output_tag_meta.name
+        output_tags.append(output_tag_json)
+    output_object_json["tags"] = output_tags
+
+    return output_object_json
+
+
+def geometry_fits(obj_class: sly.ObjClass, geometry_name: str) -> bool:
+    return (
+        obj_class.geometry_type == sly.AnyGeometry
+        or obj_class.geometry_type.geometry_name() == geometry_name
+    )
+
+
+def update_annotation(
+    plan: MetaPlan,
+    input_ann: sly.Annotation,
+    img_size: Tuple[int, int],
+    input_project_id: int,
+) -> sly.Annotation:
+    obj_classes = plan.obj_classes[input_project_id]
+    tag_metas = plan.tag_metas[input_project_id]
+
+    output_labels = []
+    for label in input_ann.labels:
+        output_labels.extend(update_label(label, obj_classes, tag_metas))
+
+    output_ann = sly.Annotation(img_size=img_size, labels=output_labels)
+    return output_ann
+
+
+def update_label(
+    input_label: sly.Label,
+    obj_classes: Dict[str, Optional[sly.ObjClass]],
+    tag_metas: Dict[str, Optional[sly.TagMeta]],
+) -> List[sly.Label]:
+    output_obj_class = obj_classes.get(input_label.obj_class.name)
+    if output_obj_class is None:
+        return []
+
+    tags_changed = False
+    output_tags = []
+    for tag in input_label.tags:
+        output_tag_meta = tag_metas.get(tag.name)
+        if output_tag_meta is None:
+            tags_changed = True
+            continue
+        if output_tag_meta.name != tag.name:
+            tag = tag.clone(meta=output_tag_meta)
+            tags_changed = True
+        output_tags.append(tag)
+
+    # Labels are serialized by class and tag names, so nothing is cloned when they don't change.
+    if output_obj_class.name == input_label.obj_class.name and not tags_changed:
+        return [input_label]
+
+    output_label = input_label.clone(tags=output_tags)
+    if not geometry_fits(output_obj_class, input_label.geometry.geometry_name()):
+        return output_label.convert(output_obj_class)
+    return [output_label.clone(obj_class=output_obj_class)]
@@ -0,0 +1,114 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import uuid
+from typing import List, Optional
+
+import supervisely as sly
+
+import src.config as config
+from src.api_client import MergeApi
+from src.headless import add_merge_arguments, get_merge_spec, load_env
+from src.shards import finish_sharded_merge, plan_shards, run_worker
+
+# Runs the merge sharded across worker processes, on one or several hosts:
+#   python -m src.sharded plan --project-ids 1 2 3 --workspace-id 4 --data-dir /shared/merge
+#   python -m src.sharded work --data-dir /shared/merge   # on every host, any number of times
+#   python -m src.sharded finish --data-dir /shared/merge
+# or all the steps at once with worker processes on this host:
+#   python -m src.sharded run --workers 4 --project-ids 1 2 3 --data-dir /tmp/merge
+# The data dir keeps the manifest and the journal, so it must be shared by all the workers.
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Merge image projects with sharded workers.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="Create the output and the shard manifest.")
+    add_merge_arguments(plan_parser)
+    plan_parser.add_argument("--shard-size", type=int, default=config.SHARD_SIZE)
+
+    work_parser = commands.add_parser("work", help="Merge shards until all are claimed.")
+    add_data_dir_argument(work_parser)
+    work_parser.add_argument(
+        "--worker-id", default=None, help="Unique ID of the worker, generated by default."
+    )
+
+    finish_parser = commands.add_parser("finish", help="Finish the merge of the done shards.")
+    add_data_dir_argument(finish_parser)
+
+    run_parser = commands.add_parser("run", help="Plan, run local workers and finish.")
+    add_merge_arguments(run_parser)
+    run_parser.add_argument("--shard-size", type=int, default=config.SHARD_SIZE)
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count())
+
+    return parser.parse_args(args)
+
+
+def add_data_dir_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--data-dir",
+        default=os.environ.get("SLY_APP_DATA_DIR"),
+        help="Directory for the manifest and the journal, SLY_APP_DATA_DIR env by default.",
+    )
+
+
+def get_worker_id() -> str:
+    # IDs are unique across the runs too, so a new worker never takes over the leases
+    # of a killed one, e.g. after the PIDs are reused in a new container.
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def run_local_workers(data_dir: str, workers_count: int):
+    """Runs the workers in the child processes and waits for all of them."""
+    run_id = uuid.uuid4().hex[:8]
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "src.sharded",
+                "work",
+                "--data-dir",
+                data_dir,
+                "--worker-id",
+                f"{socket.gethostname()}-{run_id}-{worker_index}",
+            ]
+        )
+        for worker_index in range(workers_count)
+    ]
+    return_codes = [process.wait() for process in processes]
+    failed_count = sum(1 for return_code in return_codes if return_code != 0)
+    if failed_count:
+        raise RuntimeError(
+            f"{failed_count} of {workers_count} workers failed, run the command again to resume."
+        )
+
+
+def main(args: Optional[List[str]] = None):
+    load_env()
+
+    args = parse_args(args)
+    if not args.data_dir:
+        raise ValueError("Directory for the manifest must be specified with --data-dir.")
+
+    api = MergeApi.from_env()
+    if args.command == "plan":
+        plan_shards(api, get_merge_spec(args), args.data_dir, args.shard_size)
+    elif args.command == "work":
+        worker_id = args.worker_id or get_worker_id()
+        run_worker(api, args.data_dir, worker_id)
+    elif args.command == "finish":
+        output_project_info = finish_sharded_merge(api, args.data_dir)
+        sly.logger.info(f"Merged projects into project with ID {output_project_info.id}.")
+    elif args.command == "run":
+        plan_shards(api, get_merge_spec(args), args.data_dir, args.shard_size)
+        run_local_workers(args.data_dir, args.workers)
+        output_project_info = finish_sharded_merge(api, args.data_dir)
+        sly.logger.info(f"Merged projects into project with ID {output_project_info.id}.")
+
+
+if __name__ == "__main__":
+    main()
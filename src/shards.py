@@ -0,0 +1,453 @@
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import supervisely as sly
+
+import src.config as config
+from src.merge import (
+    MergeContext,
+    MergeSpec,
+    check_cancelled,
+    finish_merge,
+    get_merge_key,
+    open_sync_index,
+    prepare_indexes,
+    prepare_output,
+    set_clone_project_ids,
+    spec_from_json,
+    spec_to_json,
+    start_remap_pool,
+    upload_dataset,
+    upload_promoted_images,
+)
+from src.meta_plan import MetaPlan
+from src.name_index import get_free_name
+
+# Sharded merge for the projects, which are too large for one process. The coordinator
+# creates the output project, its meta and datasets once, and splits the input datasets into
+# shards of image ID ranges in the manifest. Workers in any number of processes, on one or
+# several hosts, claim the shards from the manifest and merge them with the same engine.
+# Workers never write the output meta, and names of the output images are reserved in the
+# manifest, so the workers don't race on them. The coordinator finishes the merge, when all
+# shards are done. The manifest and the journal are SQLite files in the data dir, so the data
+# dir must be shared by all the workers, e.g. on NFS with working file locks.
+
+Shard = namedtuple(
+    "Shard",
+    [
+        "shard_id",
+        "input_project_id",
+        "input_dataset_id",
+        "output_dataset_id",
+        # Inclusive range of the input image IDs.
+        "first_image_id",
+        "last_image_id",
+    ],
+)
+
+
+class ShardManifest:
+    """Shards of the merge and the names of the output images, shared by all the workers.
+
+    A shard is claimed by a worker with a lease, which the worker renews while it's merging it.
+    Shards with expired leases, e.g. of the killed workers, are claimed again by other workers,
+    and the journal makes sure that their uploaded images are not uploaded twice.
+    Every claim and name reservation is one write transaction, so concurrent workers see
+    each other's changes.
+    """
+
+    def __init__(self, path: str):
+        self._lock = Lock()
+        # Shards, which are being merged by this process, only their leases are renewed.
+        self._claimed_shard_ids: Set[int] = set()
+        # Output dataset ID -> name -> next suffix of its free names.
+        self._next_suffixes: Dict[int, Dict[str, int]] = {}
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Transactions are started explicitly, to take the write lock before reading.
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, timeout=config.SQLITE_TIMEOUT, isolation_level=None
+        )
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id INTEGER PRIMARY KEY,
+                input_project_id INTEGER NOT NULL,
+                input_dataset_id INTEGER NOT NULL,
+                output_dataset_id INTEGER NOT NULL,
+                first_image_id INTEGER NOT NULL,
+                last_image_id INTEGER NOT NULL,
+                images_count INTEGER NOT NULL,
+                worker_id TEXT,
+                lease_expires_at REAL NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS names (
+                output_dataset_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                PRIMARY KEY (output_dataset_id, name)
+            );
+            """
+        )
+
+    def get_setting(self, key: str) -> Any:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM settings WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def reset(self, settings: dict):
+        """Removes the shards and names of the previous merge and saves the new settings."""
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM settings")
+            connection.execute("DELETE FROM shards")
+            connection.execute("DELETE FROM names")
+            connection.executemany(
+                "INSERT INTO settings VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in settings.items()],
+            )
+
+    def set_setting(self, key: str, value):
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, json.dumps(value))
+            )
+
+    def add_shards(self, shards: List[Tuple[int, int, int, int, int, int]]):
+        """Adds shards as (input project ID, input dataset ID, output dataset ID,
+        first image ID, last image ID, images count) tuples."""
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO shards (input_project_id, input_dataset_id, output_dataset_id, "
+                "first_image_id, last_image_id, images_count) VALUES (?, ?, ?, ?, ?, ?)",
+                shards,
+            )
+
+    def get_jobs(self) -> List[Tuple[int, int, int]]:
+        """Returns (input project ID, input dataset ID, output dataset ID) of the shards."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT DISTINCT input_project_id, input_dataset_id, output_dataset_id "
+                "FROM shards ORDER BY input_dataset_id"
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def get_progress(self) -> Tuple[int, int]:
+        """Returns numbers of the done shards and of all shards."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT COALESCE(SUM(done), 0), COUNT(*) FROM shards"
+            ).fetchone()
+        return row[0], row[1]
+
+    def claim(self, worker_id: str) -> Optional[Shard]:
+        """Claims the next shard, which is not done and not leased, None if there is none."""
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT shard_id, input_project_id, input_dataset_id, output_dataset_id, "
+                "first_image_id, last_image_id FROM shards "
+                "WHERE done = 0 AND lease_expires_at < ? ORDER BY shard_id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE shards SET worker_id = ?, lease_expires_at = ? WHERE shard_id = ?",
+                (worker_id, now + config.SHARD_LEASE_TIME, row[0]),
+            )
+            self._claimed_shard_ids.add(row[0])
+        return Shard(*row)
+
+    def renew(self, worker_id: str):
+        """Renews leases of the shards, which are being merged by the worker in this process."""
+        with self._transaction() as connection:
+            shard_ids = list(self._claimed_shard_ids)
+            # Shards, which were claimed by other workers after their leases expired, are kept.
+            connection.execute(
+                "UPDATE shards SET lease_expires_at = ? WHERE worker_id = ? AND done = 0 "
+                f"AND shard_id IN ({', '.join('?' * len(shard_ids))})",
+                (time.time() + config.SHARD_LEASE_TIME, worker_id, *shard_ids),
+            )
+
+    def release(self, shard_id: int, worker_id: str):
+        """Lets other workers claim the shard right away, e.g. after it failed."""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE shards SET worker_id = NULL, lease_expires_at = 0 "
+                "WHERE shard_id = ? AND worker_id = ?",
+                (shard_id, worker_id),
+            )
+            self._claimed_shard_ids.discard(shard_id)
+
+    def set_done(self, shard_id: int):
+        with self._transaction() as connection:
+            connection.execute("UPDATE shards SET done = 1 WHERE shard_id = ?", (shard_id,))
+            self._claimed_shard_ids.discard(shard_id)
+
+    def add_names(self, output_dataset_id: int, names: List[str]):
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO names VALUES (?, ?)",
+                [(output_dataset_id, name) for name in names],
+            )
+
+    def reserve_names(
+        self, output_dataset_id: int, names: List[str], image_conflicts: str
+    ) -> List[Optional[str]]:
+        """Returns output names for the given names, None if the image must be skipped."""
+        output_names = []
+        with self._transaction() as connection:
+            for name in names:
+                if self._has_name(connection, output_dataset_id, name):
+                    if image_conflicts == "Skip":
+                        output_names.append(None)
+                        continue
+                    name = get_free_name(
+                        name,
+                        partial(self._has_name, connection, output_dataset_id),
+                        self._next_suffixes.setdefault(output_dataset_id, {}),
+                    )
+                connection.execute("INSERT INTO names VALUES (?, ?)", (output_dataset_id, name))
+                output_names.append(name)
+        return output_names
+
+    def _has_name(self, connection: sqlite3.Connection, output_dataset_id: int, name: str) -> bool:
+        return (
+            connection.execute(
+                "SELECT 1 FROM names WHERE output_dataset_id = ? AND name = ?",
+                (output_dataset_id, name),
+            ).fetchone()
+            is not None
+        )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # The write lock is taken at the start, so other workers can't claim the same shard
+        # or reserve the same name between the read and the write.
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+
+class SharedNameIndex:
+    """Name index of the output dataset in the manifest, with the same interface as NameIndex."""
+
+    def __init__(self, manifest: ShardManifest, output_dataset_id: int):
+        self._manifest = manifest
+        self._output_dataset_id = output_dataset_id
+
+    def reserve(self, names: List[str], image_conflicts: str) -> List[Optional[str]]:
+        return self._manifest.reserve_names(self._output_dataset_id, names, image_conflicts)
+
+
+def open_manifest(data_dir: str) -> ShardManifest:
+    return ShardManifest(os.path.join(data_dir, config.SHARD_MANIFEST_FILENAME))
+
+
+def plan_shards(
+    api: sly.Api, spec: MergeSpec, data_dir: str, shard_size: int = config.SHARD_SIZE
+) -> ShardManifest:
+    """Creates (or resumes) the output of the merge and splits its input datasets into shards.
+
+    The manifest of the unfinished merge with the same settings is kept as is, so the workers
+    continue it from the done shards.
+    """
+    ctx = MergeContext(api, spec, data_dir)
+    ctx.stats.attach(api)
+    manifest = open_manifest(data_dir)
+    try:
+        jobs = prepare_output(ctx)
+
+        if (
+            manifest.get_setting("merge_key") == get_merge_key(spec)
+            and manifest.get_setting("output_project_id") == ctx.output_project_id
+            and manifest.get_setting("planned")
+        ):
+            done_count, shards_count = manifest.get_progress()
+            sly.logger.info(
+                f"Resuming sharded merge, {done_count} of {shards_count} shards are done."
+            )
+            return manifest
+
+        manifest.reset(
+            {
+                "merge_key": get_merge_key(spec),
+                "spec": spec_to_json(spec),
+                "output_project_id": ctx.output_project_id,
+                "meta_plan": ctx.meta_plan.to_json(),
+            }
+        )
+        with ctx.stats.stage("listing") as record:
+            for input_project_id, input_dataset_id, output_dataset_id in jobs:
+                manifest.add_shards(
+                    [
+                        (input_project_id, input_dataset_id, output_dataset_id, *shard)
+                        for shard in list_shards(api, input_dataset_id, shard_size)
+                    ]
+                )
+            # Output datasets may have images already, e.g. if they are synced.
+            for output_dataset_id in {job[2] for job in jobs}:
+                for image_infos in api.image.get_list_generator(
+                    output_dataset_id,
+                    batch_size=config.UPLOAD_WINDOW_SIZE,
+                    force_metadata_for_links=False,
+                ):
+                    manifest.add_names(output_dataset_id, [info.name for info in image_infos])
+                    record.items += len(image_infos)
+        manifest.set_setting("planned", True)
+    finally:
+        ctx.stats.detach()
+
+    _, shards_count = manifest.get_progress()
+    sly.logger.info(
+        f"Split {len(jobs)} datasets into {shards_count} shards of up to {shard_size} images."
+    )
+    return manifest
+
+
+def list_shards(
+    api: sly.Api, input_dataset_id: int, shard_size: int
+) -> Iterator[Tuple[int, int, int]]:
+    """Yields (first image ID, last image ID, images count) of the shards of the dataset."""
+    first_image_id = last_image_id = None
+    images_count = 0
+    # Images are listed in the order of their IDs.
+    for image_infos in api.image.get_list_generator(
+        input_dataset_id, batch_size=config.UPLOAD_WINDOW_SIZE, force_metadata_for_links=False
+    ):
+        for image_info in image_infos:
+            if images_count == 0:
+                first_image_id = image_info.id
+            last_image_id = image_info.id
+            images_count += 1
+            if images_count == shard_size:
+                yield first_image_id, last_image_id, images_count
+                images_count = 0
+    if images_count:
+        yield first_image_id, last_image_id, images_count
+
+
+def open_shard_context(
+    api: sly.Api, manifest: ShardManifest, data_dir: str, cancel_event: Optional[Event] = None
+) -> MergeContext:
+    """Creates the context of the planned merge without writing anything to the instance."""
+    ctx = MergeContext(api, spec_from_json(manifest.get_setting("spec")), data_dir, cancel_event)
+    ctx.output_project_id = manifest.get_setting("output_project_id")
+    ctx.meta_plan = MetaPlan.from_json(manifest.get_setting("meta_plan"))
+    ctx.meta_plan.used_class_names.update(ctx.journal.get_used_class_names())
+    return ctx
+
+
+def run_worker(
+    api: sly.Api, data_dir: str, worker_id: str, cancel_event: Optional[Event] = None
+) -> int:
+    """Merges the shards claimed from the manifest until all are claimed.
+
+    Shards are merged by MERGE_WORKERS threads. Returns the number of the merged shards.
+    """
+    manifest = open_manifest(data_dir)
+    if not manifest.get_setting("planned"):
+        raise ValueError(f"Sharded merge is not planned in {data_dir}.")
+
+    ctx = open_shard_context(api, manifest, data_dir, cancel_event)
+    ctx.stats.attach(api)
+    stop_heartbeat = Event()
+    heartbeat = Thread(target=renew_leases, args=(manifest, worker_id, stop_heartbeat))
+    heartbeat.start()
+    try:
+        open_sync_index(ctx)
+        set_clone_project_ids(ctx)
+        jobs = manifest.get_jobs()
+        ctx.name_indexes = {
+            output_dataset_id: SharedNameIndex(manifest, output_dataset_id)
+            for _, _, output_dataset_id in jobs
+        }
+        prepare_indexes(ctx, jobs)
+
+        shards_count = 0
+        with start_remap_pool(ctx), ThreadPoolExecutor(config.MERGE_WORKERS) as executor:
+            futures = [
+                executor.submit(merge_shards, ctx, manifest, worker_id)
+                for _ in range(config.MERGE_WORKERS)
+            ]
+            try:
+                for future in as_completed(futures):
+                    shards_count += future.result()
+            except BaseException:
+                ctx.cancel_event.set()
+                raise
+            # Duplicates promoted by this worker may be in the shards of other workers, which
+            # skipped them, so they are merged by this worker.
+            upload_promoted_images(ctx, jobs)
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
+        ctx.stats.detach()
+
+    sly.logger.info(f"Worker {worker_id} merged {shards_count} shards.")
+    sly.logger.info(f"Worker stats: {ctx.stats.to_lines()}")
+    return shards_count
+
+
+def merge_shards(ctx: MergeContext, manifest: ShardManifest, worker_id: str) -> int:
+    shards_count = 0
+    while True:
+        check_cancelled(ctx)
+        shard = manifest.claim(worker_id)
+        if shard is None:
+            return shards_count
+        sly.logger.info(
+            f"Worker {worker_id} claimed shard {shard.shard_id} of images "
+            f"{shard.first_image_id}-{shard.last_image_id} of dataset {shard.input_dataset_id}."
+        )
+        try:
+            upload_dataset(
+                ctx,
+                shard.input_project_id,
+                shard.input_dataset_id,
+                shard.output_dataset_id,
+                (shard.first_image_id, shard.last_image_id),
+            )
+        except BaseException:
+            manifest.release(shard.shard_id, worker_id)
+            raise
+        manifest.set_done(shard.shard_id)
+        shards_count += 1
+
+
+def renew_leases(manifest: ShardManifest, worker_id: str, stop: Event):
+    while not stop.wait(config.SHARD_LEASE_TIME / 3):
+        manifest.renew(worker_id)
+
+
+def finish_sharded_merge(api: sly.Api, data_dir: str) -> sly.ProjectInfo:
+    """Finishes the merge, when all its shards are done, e.g. removes the empty classes."""
+    manifest = open_manifest(data_dir)
+    done_count, shards_count = manifest.get_progress()
+    if not manifest.get_setting("planned") or done_count < shards_count:
+        raise ValueError(
+            f"Sharded merge is not done yet, {done_count} of {shards_count} shards are done."
+        )
+
+    ctx = open_shard_context(api, manifest, data_dir)
+    ctx.stats.attach(api)
+    return finish_merge(ctx)
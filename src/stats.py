@@ -0,0 +1,191 @@
+import json
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import supervisely as sly
+
+# Stages in the order of the merge, the same as in the merge estimate.
+STAGES = [
+    "meta fetch",
+    "meta update",
+    "dataset creation",
+    "listing",
+    "annotation download",
+    "label remapping",
+    "image upload",
+    "annotation upload",
+    "tag upload",
+]
+# Key of the stages, which don't belong to any dataset.
+MERGE_KEY = "merge"
+# Stage of the API calls, which were made outside of the measured stages.
+OTHER_STAGE = "other"
+
+_END = object()
+
+
+class StageRecord:
+    def __init__(self):
+        self.duration = 0.0
+        self.items = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.api_calls = Counter()
+
+    def add(self, other: "StageRecord"):
+        self.duration += other.duration
+        self.items += other.items
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.api_calls.update(other.api_calls)
+
+    def to_json(self) -> dict:
+        return {
+            "duration": round(self.duration, 3),
+            "items": self.items,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "api_calls": dict(sorted(self.api_calls.items())),
+        }
+
+
+class MergeStats:
+    """Durations, item counts, bytes and API calls of every stage of every dataset.
+
+    API calls are counted by wrapping `post` and `get` of the API instance while the stats
+    are attached to it, and are assigned to the stage, which runs in the calling thread.
+    Stages of different datasets and of the dataset pipeline run concurrently, so their
+    durations add up to more than the wall time.
+    """
+
+    def __init__(self):
+        self._records: Dict[Tuple[str, str], StageRecord] = {}
+        self._lock = Lock()
+        self._current = local()
+        self._api: Optional[sly.Api] = None
+        self._started_at = time.time()
+        self._wall_time = None
+        # Latency histograms of the API endpoints, if the API client measures them.
+        self.api_latency: Optional[dict] = None
+
+    def attach(self, api: sly.Api):
+        # Methods of the class are wrapped, so attaching again doesn't count calls twice.
+        for method_name in ["post", "get"]:
+            method = getattr(type(api), method_name).__get__(api)
+            setattr(api, method_name, self._wrap(method))
+        self._api = api
+
+    def detach(self):
+        # Detaching again, e.g. after a failed merge, keeps the wall time of the first one.
+        if self._api is None:
+            return
+        self._api.__dict__.pop("post", None)
+        self._api.__dict__.pop("get", None)
+        self._api = None
+        self._wall_time = time.time() - self._started_at
+
+    @contextmanager
+    def stage(self, name: str, dataset_key: str = MERGE_KEY) -> Iterator[StageRecord]:
+        """Measures the block as the stage, the caller may add items to the yielded record."""
+        record = StageRecord()
+        previous = getattr(self._current, "record", None)
+        self._current.record = record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.duration = time.perf_counter() - start
+            self._current.record = previous
+            with self._lock:
+                self._records.setdefault((dataset_key, name), StageRecord()).add(record)
+
+    def get_bytes_sent(self) -> int:
+        """Returns bytes sent by the stage, which runs in the calling thread."""
+        record = getattr(self._current, "record", None)
+        return record.bytes_sent if record is not None else 0
+
+    def add_items(self, count: int):
+        """Adds items to the stage, which runs in the calling thread."""
+        record = getattr(self._current, "record", None)
+        if record is not None:
+            record.items += count
+
+    def iterate(self, name: str, dataset_key: str, pages: Iterable[list]) -> Iterator[list]:
+        """Measures fetching every page of the iterable as the stage."""
+        pages = iter(pages)
+        while True:
+            with self.stage(name, dataset_key) as record:
+                page = next(pages, _END)
+                if page is not _END:
+                    record.items += len(page)
+            if page is _END:
+                return
+            yield page
+
+    def get_totals(self) -> Dict[str, StageRecord]:
+        totals = OrderedDict((name, StageRecord()) for name in STAGES)
+        with self._lock:
+            for (_, name), record in self._records.items():
+                totals.setdefault(name, StageRecord()).add(record)
+        return totals
+
+    def to_json(self) -> dict:
+        datasets = {}
+        with self._lock:
+            for (dataset_key, name), record in sorted(self._records.items()):
+                datasets.setdefault(dataset_key, {})[name] = record.to_json()
+
+        totals = self.get_totals()
+        api_calls = Counter()
+        for record in totals.values():
+            api_calls.update(record.api_calls)
+
+        return {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._started_at)),
+            "wall_time": round(self._wall_time, 3) if self._wall_time is not None else None,
+            "api_calls": dict(sorted(api_calls.items())),
+            "totals": {name: record.to_json() for name, record in totals.items()},
+            "datasets": datasets,
+            "api_latency": self.api_latency,
+        }
+
+    def to_lines(self) -> List[str]:
+        lines = []
+        if self._wall_time is not None:
+            lines.append(f"Total time: {self._wall_time:.1f} s")
+        for name, record in self.get_totals().items():
+            lines.append(
+                f"{name}: {record.duration:.1f} s, {record.items} items, "
+                f"{sum(record.api_calls.values())} API calls, "
+                f"{(record.bytes_sent + record.bytes_received) / 2**20:.1f} MB"
+            )
+        return lines
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=4)
+        sly.logger.info(f"Merge report was saved to {path}.")
+
+    def _wrap(self, method):
+        def wrapper(endpoint: str, *args, **kwargs):
+            response = method(endpoint, *args, **kwargs)
+
+            record = getattr(self._current, "record", None)
+            if record is None:
+                with self._lock:
+                    record = self._records.setdefault((MERGE_KEY, OTHER_STAGE), StageRecord())
+                    record.api_calls[endpoint] += 1
+                return response
+            record.api_calls[endpoint] += 1
+            request = getattr(response, "request", None)
+            if request is not None and request.body:
+                record.bytes_sent += len(request.body)
+            # Content of the streamed responses is read by the caller.
+            if response is not None and not kwargs.get("stream"):
+                record.bytes_received += len(getattr(response, "content", None) or b"")
+            return response
+
+        return wrapper
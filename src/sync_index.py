@@ -0,0 +1,193 @@
+import os
+import sqlite3
+from collections import namedtuple
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import supervisely as sly
+
+import src.config as config
+from src.db import fetch_by_ids
+
+SyncedImage = namedtuple(
+    "SyncedImage",
+    [
+        "input_image_id",
+        "output_image_id",
+        "output_dataset_id",
+        "output_image_name",
+        "updated_at",
+    ],
+)
+
+
+class SyncIndex:
+    """Local index of the source images, which were merged into the output project.
+
+    Every merged image records its source image ID, update time and the key of its output
+    dataset in the output image meta, and the index is a local copy of these records, so a sync
+    doesn't list the output project. The index is kept only for the synced projects, if it has
+    no records of the output project (e.g. the data dir is new, or the project was merged
+    without sync), it's rebuilt from the output image metas once.
+    Output datasets are indexed by the keys of their sources, because datasets with the same
+    names are renamed in the output project, so a sync can't find them by the names.
+    """
+
+    def __init__(self, path: str, output_project_id: int):
+        self._output_project_id = output_project_id
+        self._lock = Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, timeout=config.SQLITE_TIMEOUT
+        )
+        with self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS images (
+                    output_project_id INTEGER NOT NULL,
+                    input_image_id INTEGER NOT NULL,
+                    output_image_id INTEGER NOT NULL,
+                    output_dataset_id INTEGER NOT NULL,
+                    output_image_name TEXT NOT NULL,
+                    updated_at TEXT,
+                    PRIMARY KEY (output_project_id, input_image_id)
+                );
+                CREATE TABLE IF NOT EXISTS datasets (
+                    output_project_id INTEGER NOT NULL,
+                    dataset_key TEXT NOT NULL,
+                    output_dataset_id INTEGER NOT NULL,
+                    PRIMARY KEY (output_project_id, dataset_key)
+                );
+                """
+            )
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM images WHERE output_project_id = ? LIMIT 1",
+                (self._output_project_id,),
+            ).fetchone()
+        return row is None
+
+    def load(self, api: sly.Api):
+        """Rebuilds the index from the meta of the output images."""
+        synced_images = []
+        for image_info, source in iterate_sources(api, self._output_project_id):
+            synced_images.append(get_synced_image(image_info, source))
+            # Images, which were merged by the older versions, have no dataset keys.
+            if source.get("dataset_key"):
+                self.add_output_dataset(source["dataset_key"], image_info.dataset_id)
+        self.add_images(synced_images)
+        sly.logger.info(
+            f"Loaded {len(synced_images)} synced images of output project "
+            f"{self._output_project_id} to the sync index."
+        )
+
+    def get_images(self, input_image_ids: List[int]) -> Dict[int, SyncedImage]:
+        rows = fetch_by_ids(
+            self._connection,
+            self._lock,
+            "SELECT input_image_id, output_image_id, output_dataset_id, "
+            "output_image_name, updated_at FROM images "
+            "WHERE output_project_id = ? AND input_image_id IN ({placeholders})",
+            (self._output_project_id,),
+            input_image_ids,
+        )
+        return {row[0]: SyncedImage(*row) for row in rows}
+
+    def add_images(self, synced_images: List[SyncedImage]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+                [(self._output_project_id, *synced_image) for synced_image in synced_images],
+            )
+
+    def remove_images(self, input_image_ids: List[int]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM images WHERE output_project_id = ? AND input_image_id = ?",
+                [(self._output_project_id, input_id) for input_id in input_image_ids],
+            )
+
+    def get_output_dataset_id(self, dataset_key: str) -> Optional[int]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT output_dataset_id FROM datasets "
+                "WHERE output_project_id = ? AND dataset_key = ?",
+                (self._output_project_id, dataset_key),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_dataset_key(self, output_dataset_id: int) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT dataset_key FROM datasets "
+                "WHERE output_project_id = ? AND output_dataset_id = ?",
+                (self._output_project_id, output_dataset_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def add_output_dataset(self, dataset_key: str, output_dataset_id: int):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?)",
+                (self._output_project_id, dataset_key, output_dataset_id),
+            )
+
+    def clear(self):
+        """Removes all records of the output project."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM images WHERE output_project_id = ?", (self._output_project_id,)
+            )
+            self._connection.execute(
+                "DELETE FROM datasets WHERE output_project_id = ?", (self._output_project_id,)
+            )
+
+
+def get_source_meta(image_info: sly.ImageInfo) -> dict:
+    """Returns meta of the output image with the source of the input image."""
+    meta = dict(image_info.meta or {})
+    meta[config.SOURCE_META_KEY] = {"image_id": image_info.id, "updated_at": image_info.updated_at}
+    return meta
+
+
+def set_source_dataset(meta: dict, dataset_key: Optional[str]):
+    """Records the key of the output dataset in the source of the output image meta."""
+    meta[config.SOURCE_META_KEY]["dataset_key"] = dataset_key
+
+
+def get_synced_images(api: sly.Api, output_project_id: int) -> List[SyncedImage]:
+    return [
+        get_synced_image(image_info, source)
+        for image_info, source in iterate_sources(api, output_project_id)
+    ]
+
+
+def iterate_sources(api: sly.Api, output_project_id: int) -> Iterator[Tuple[sly.ImageInfo, dict]]:
+    """Yields output images with their sources, which were merged by the app."""
+    for image_infos in api.image.get_list_generator(
+        project_id=output_project_id,
+        batch_size=config.UPLOAD_WINDOW_SIZE,
+        force_metadata_for_links=False,
+    ):
+        for image_info in image_infos:
+            source = (image_info.meta or {}).get(config.SOURCE_META_KEY)
+            if source:
+                yield image_info, source
+
+
+def get_synced_image(image_info: sly.ImageInfo, source: dict) -> SyncedImage:
+    return SyncedImage(
+        source["image_id"],
+        image_info.id,
+        image_info.dataset_id,
+        image_info.name,
+        source.get("updated_at"),
+    )
+
+
+def is_changed(image_info: sly.ImageInfo, synced_image: Optional[SyncedImage]) -> bool:
+    # Image update time is changed by the instance with its annotation and tags too.
+    return synced_image is None or synced_image.updated_at != image_info.updated_at
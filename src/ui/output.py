@@ -1,5 +1,5 @@
-from collections import defaultdict
-from typing import List, Optional, Tuple
+from threading import Event, Thread
+from typing import List
 
 import supervisely as sly
 from supervisely.app.widgets import (
@@ -7,16 +7,21 @@ from supervisely.app.widgets import (
     Card,
     Container,
     Field,
+    Flexbox,
     Input,
+    InputNumber,
     Progress,
     ProjectThumbnail,
     Select,
+    SelectProject,
     Switch,
     Text,
 )
-from supervisely.collection.key_indexed_collection import DuplicateKeyError
 
 import src.globals as g
+from src.api_client import MergeApi
+from src.estimate import estimate_merge
+from src.merge import MergeCancelled, MergeSpec, finish_merge, prepare_merge, run_jobs
 
 dataset_structure_select = Select(items=[Select.Item(value=value) for value in g.DATASET_CONFLICTS])
 dataset_structure_field = Field(
@@ -33,6 +38,10 @@ output_project_field = Field(
 )
 
 merge_button = Button("Merge")
+plan_button = Button("Plan", button_type="info", plain=True, icon="zmdi zmdi-assignment")
+cancel_button = Button("Cancel", button_type="danger", plain=True, icon="zmdi zmdi-close")
+cancel_button.hide()
+buttons_flexbox = Flexbox([merge_button, plan_button, cancel_button])
 
 merge_progress = Progress()
 
@@ -49,6 +58,43 @@ include_empty_classes_field = Field(
     content=include_empty_classes_switch,
 )
 
+sync_switch = Switch()
+sync_project_select = SelectProject(
+    workspace_id=g.STATE.selected_workspace,
+    compact=True,
+    show_label=False,
+)
+sync_project_select.hide()
+sync_field = Field(
+    title="Sync into existing project",
+    description="Merge only new and changed images into the project, which was merged before.",
+    content=Container([sync_switch, sync_project_select]),
+)
+
+name_pattern_input = Input(placeholder="Image name pattern, e.g. *.png")
+tag_names_input = Input(placeholder="Image tags, separated by commas")
+class_names_input = Input(placeholder="Classes, separated by commas")
+min_labels_count_input = InputNumber(value=0, min=0)
+filter_field = Field(
+    title="Filter images",
+    description=(
+        "Merge only images, which match the name pattern, have any of the image tags, "
+        "labels of any of the classes and at least the given number of labels. "
+        "Empty fields are not applied."
+    ),
+    content=Container(
+        [name_pattern_input, tag_names_input, class_names_input, min_labels_count_input]
+    ),
+)
+
+sample_size_input = InputNumber(value=0, min=0)
+sample_mode_select = Select(items=[Select.Item(value=value) for value in g.SAMPLE_MODES])
+sample_field = Field(
+    title="Sample images",
+    description="Number of images to sample from every input project, 0 to merge all images.",
+    content=Container([sample_size_input, sample_mode_select]),
+)
+
 card = Card(
     title="3️⃣ Output",
     description="Choose the name for output project and start the merging process.",
@@ -57,7 +103,10 @@ card = Card(
             dataset_structure_field,
             include_empty_classes_field,
             output_project_field,
-            merge_button,
+            sync_field,
+            filter_field,
+            sample_field,
+            buttons_flexbox,
             merge_progress,
             result_text,
             project_thumbnail,
@@ -70,340 +119,128 @@ card.lock()
 card.collapse()
 
 
-@merge_button.click
-def merge():
-    g.STATE.output_project_meta = None
-    g.STATE.output_project_id = None
-    result_text.hide()
-    project_thumbnail.hide()
-    merge_button.text = "Merging..."
-    create_project(output_project_input.get_value())
-
-    dataset_structure = dataset_structure_select.get_value()
-    sly.logger.debug(f"Dataset structure is set to {dataset_structure}, starting merging...")
-
-    if dataset_structure == "Merge into one dataset":
-        output_dataset_id = create_dataset("Merged dataset").id
-
-    sly.logger.debug(f"Starting iteration over {len(g.STATE.project_ids)} projects to merge...")
-
-    add_tag_meta_to_output_project()
-
-    with merge_progress(message="Merging projects...", total=len(g.STATE.project_ids)) as pbar:
-        for input_project_id in g.STATE.project_ids:
-            input_datasets = g.api.dataset.get_list(input_project_id)
-            input_dataset_ids = [dataset.id for dataset in input_datasets]
-
-            if dataset_structure == "Merge into one dataset":
-                for input_dataset_id in input_dataset_ids:
-                    upload_dataset(input_project_id, input_dataset_id, output_dataset_id)
-            elif dataset_structure == "Separate dataset for each project":
-                input_project_name = g.api.project.get_info_by_id(input_project_id).name
-                output_dataset_id = create_dataset(input_project_name).id
-
-                for input_dataset_id in input_dataset_ids:
-                    upload_dataset(input_project_id, input_dataset_id, output_dataset_id)
-            elif dataset_structure == "Use hierarchical structure":
-                input_project_name = g.api.project.get_info_by_id(input_project_id).name
-                parent_dataset = create_dataset(input_project_name)
-                for input_dataset in input_datasets:
-                    output_dataset_id = create_dataset(
-                        input_dataset.name, parent_id=parent_dataset.id
-                    ).id
-                    upload_dataset(input_project_id, input_dataset.id, output_dataset_id)
-
-            elif dataset_structure == "Save original names":
-                input_dataset_names = [dataset.name for dataset in input_datasets]
-                output_dataset_ids = [
-                    create_dataset(dataset_name).id for dataset_name in input_dataset_names
-                ]
-
-                for input_dataset_id, output_dataset_id in zip(
-                    input_dataset_ids, output_dataset_ids
-                ):
-                    upload_dataset(input_project_id, input_dataset_id, output_dataset_id)
-
-            pbar.update(1)
-
-    # TODO: Include empty classes if switch is on.
-    if include_empty_classes_switch.is_on():
-        sly.logger.info(f"Including empty classes in output project {g.STATE.output_project_id}...")
-        include_empty_classes(g.STATE.project_ids, g.STATE.output_project_id)
-        sly.logger.info(f"Included empty classes in output project {g.STATE.output_project_id}.")
-
-    result_text.text = "Successfully merged projects."
-    result_text.status = "success"
-    result_text.show()
-
-    project_thumbnail.set(g.api.project.get_info_by_id(g.STATE.output_project_id))
-    project_thumbnail.show()
-
-    merge_button.text = "Merge"
-
-    sly.logger.info(f"Successfully merged {len(g.STATE.project_ids)} projects. App finished.")
-
-    from src.main import app
-
-    app.stop()
+def get_merge_spec() -> MergeSpec:
+    return MergeSpec(
+        workspace_id=g.STATE.selected_workspace,
+        project_ids=g.STATE.project_ids,
+        conflict_settings=g.STATE.conflict_settings,
+        dataset_structure=dataset_structure_select.get_value(),
+        output_project_name=output_project_input.get_value(),
+        include_empty_classes=include_empty_classes_switch.is_on(),
+        sync_project_id=sync_project_select.get_selected_id() if sync_switch.is_on() else None,
+        image_filter=g.ImageFilter(
+            name_pattern=name_pattern_input.get_value().strip(),
+            tag_names=split_names(tag_names_input.get_value()),
+            class_names=split_names(class_names_input.get_value()),
+            min_labels_count=int(min_labels_count_input.get_value() or 0),
+            sample_size=int(sample_size_input.get_value() or 0),
+            sample_mode=sample_mode_select.get_value(),
+        ),
+    )
 
 
-def include_empty_classes(input_project_ids: List[int], output_project_id: int):
-    output_project_meta = sly.ProjectMeta.from_json(g.api.project.get_meta(output_project_id))
+def split_names(text: str) -> List[str]:
+    return [name.strip() for name in (text or "").split(",") if name.strip()]
 
-    for input_project_id in input_project_ids:
-        input_project_meta = sly.ProjectMeta.from_json(g.api.project.get_meta(input_project_id))
-        for obj_class in input_project_meta.obj_classes:
-            if obj_class not in output_project_meta.obj_classes:
-                output_project_meta = output_project_meta.add_obj_class(obj_class)
-                sly.logger.debug(f'Added object class "{obj_class.name}" to output project.')
 
-    g.api.project.update_meta(output_project_id, output_project_meta)
-    sly.logger.debug(f"Updated object classes for output project {output_project_id}.")
+@sync_switch.value_changed
+def sync_changed(is_on: bool):
+    if is_on:
+        sync_project_select.show()
+        output_project_field.hide()
+    else:
+        sync_project_select.hide()
+        output_project_field.show()
 
 
-def create_project(project_name: Optional[str]) -> int:
-    if not project_name:
-        project_name = "Merged project"
+@plan_button.click
+def plan():
+    result_text.hide()
+    plan_button.text = "Planning..."
 
-    g.STATE.output_project_id = g.api.project.create(
-        g.STATE.selected_workspace, project_name, change_name_if_conflict=True
-    ).id
+    try:
+        estimate = estimate_merge(g.api, get_merge_spec())
+        result_text.text = "<br>".join(["Merge plan:"] + estimate.to_lines())
+        result_text.status = "info"
+    except Exception as e:
+        sly.logger.exception(f"Planning failed: {e}")
+        result_text.text = f"Planning failed: {e}"
+        result_text.status = "error"
+    finally:
+        # Button is reset after any error, so the merge can be planned again.
+        result_text.show()
+        plan_button.text = "Plan"
 
-    sly.logger.info(
-        f"Created output project with ID {g.STATE.output_project_id} and saved it to state."
-    )
 
+@merge_button.click
+def merge():
+    result_text.hide()
+    project_thumbnail.hide()
+    merge_button.text = "Merging..."
+    merge_button.disable()
+    plan_button.disable()
+    cancel_button.show()
 
-def upload_dataset(input_project_id, input_dataset_id, output_dataset_id):
-    sly.logger.info(
-        f"Starting uploading dataset with ID {input_dataset_id} to dataset with ID {output_dataset_id}..."
-    )
+    # The merge runs in the background, so the handler returns and the UI stays responsive.
+    g.STATE.cancel_event = Event()
+    Thread(target=run_merge, args=(get_merge_spec(), g.STATE.cancel_event), daemon=True).start()
 
-    input_image_infos = g.api.image.get_list(input_dataset_id)
-    input_project_meta = sly.ProjectMeta.from_json(g.api.project.get_meta(input_project_id))
-
-    image_ids = [image_info.id for image_info in input_image_infos]
-    ann_jsons = g.api.annotation.download_json_batch(input_dataset_id, image_ids)
-    input_anns = []
-    for ann_json in ann_jsons:
-        annotation = sly.Annotation.from_json(ann_json, input_project_meta)
-        input_anns.append(annotation)
-
-    output_image_ids = []
-    output_image_names = []
-    output_image_metas = []
-    output_anns = []
-
-    existing_images_names = [
-        image_info.name for image_info in g.api.image.get_list(output_dataset_id)
-    ]
-
-    processed_image_infos = []
-
-    for image_info, ann in zip(input_image_infos, input_anns):
-        input_image_id = image_info.id
-        input_image_name = image_info.name
-        input_image_meta = image_info.meta
-
-        if input_image_name in existing_images_names:
-            sly.logger.debug(
-                f"Image with name {input_image_name} already exists in output dataset."
-            )
-
-            if g.STATE.conflict_settings.image_conflicts == "Skip":
-                sly.logger.debug(
-                    f"Conflict resolution is set to 'Skip', skipping image with name {input_image_name}..."
-                )
-                continue
-            elif g.STATE.conflict_settings.image_conflicts == "Rename":
-                input_image_name = g.api.image.get_free_name(output_dataset_id, input_image_name)
-
-                sly.logger.debug(
-                    f"Conflict resolution is set to 'Rename', the image was renamed to {input_image_name}."
-                )
-
-        img_size = (image_info.height, image_info.width)
-        output_ann = update_annotation(ann, img_size)
-
-        processed_image_infos.append(image_info)
-
-        output_image_ids.append(input_image_id)
-        output_image_names.append(input_image_name)
-        output_image_metas.append(input_image_meta)
-        output_anns.append(output_ann)
-
-    sly.logger.debug(
-        f"Successfully updated annotations for {len(output_anns)} images and prepared them for upload."
-    )
 
-    uploaded_image_infos = []
-
-    for (
-        batched_image_ids,
-        batched_image_names,
-        batched_image_metas,
-        batched_anns,
-    ) in zip(
-        sly.batched(output_image_ids),
-        sly.batched(output_image_names),
-        sly.batched(output_image_metas),
-        sly.batched(output_anns),
-    ):
-        batch_uploaded_image_infos = g.api.image.upload_ids(
-            output_dataset_id,
-            ids=batched_image_ids,
-            names=batched_image_names,
-            metas=batched_image_metas,
-        )
-        uploaded_image_ids = [image_info.id for image_info in batch_uploaded_image_infos]
+@cancel_button.click
+def cancel():
+    sly.logger.info("Cancel button was pressed, stopping the merge at the next batch...")
+    cancel_button.text = "Cancelling..."
+    cancel_button.disable()
+    g.STATE.cancel_event.set()
 
-        g.api.annotation.upload_anns(uploaded_image_ids, batched_anns)
 
-        sly.logger.debug(
-            f"Successfully uploaded batch of {len(uploaded_image_ids)} images with annotations."
+def run_merge(spec: MergeSpec, cancel_event: Event):
+    ctx = None
+    try:
+        # Every merge has its own client, so the report has latencies of this merge only.
+        api = MergeApi.from_api(g.api)
+        ctx, jobs = prepare_merge(api, spec, g.SLY_APP_DATA_DIR, cancel_event)
+        g.STATE.output_project_id = ctx.output_project_id
+
+        # Progress is updated only from this thread, as the dataset jobs are completed.
+        with merge_progress(message="Merging datasets...", total=len(jobs)) as pbar:
+            run_jobs(ctx, jobs, pbar.update)
+
+        output_project_info = finish_merge(ctx)
+    except MergeCancelled:
+        sly.logger.info("Merge was cancelled.")
+        show_result(
+            "Merge was cancelled. Start it again with the same settings to resume.", "warning"
         )
+        return
+    except Exception as e:
+        sly.logger.exception(f"Merge failed: {e}")
+        show_result(f"Merge failed: {e}", "error")
+        return
+    finally:
+        # Stats of a failed or cancelled merge must be detached from the API too.
+        if ctx is not None:
+            ctx.stats.detach()
+
+    show_result("<br>".join(["Successfully merged projects."] + ctx.stats.to_lines()), "success")
+    project_thumbnail.set(output_project_info)
+    project_thumbnail.show()
 
-        uploaded_image_infos.extend(batch_uploaded_image_infos)
-
-    upload_image_tags(
-        input_project_id,
-        g.STATE.output_project_id,
-        processed_image_infos,
-        uploaded_image_infos,
-    )
-
-    sly.logger.info(
-        f"Finished uploading dataset with ID {input_dataset_id} to dataset with ID {output_dataset_id}."
-    )
-
+    sly.logger.info("App finished.")
 
-def upload_image_tags(
-    input_project_id: int,
-    output_project_id: int,
-    processed_image_infos: List[sly.ImageInfo],
-    uploaded_image_infos: List[sly.ImageInfo],
-):
-    input_tag_map = g.api.image.tag.get_name_to_id_map(input_project_id)
-    reversed_input_tag_map = {v: k for k, v in input_tag_map.items()}
-    output_tag_map = g.api.image.tag.get_name_to_id_map(output_project_id)
-
-    to_upload = defaultdict(list)
-
-    for input_image, output_image in zip(processed_image_infos, uploaded_image_infos):
-        input_image: sly.ImageInfo
-        input_tag_ids = [tag.get("tagId") for tag in input_image.tags]
-        input_tag_values = [tag.get("value") for tag in input_image.tags]
-        input_tag_names = [reversed_input_tag_map[tag_id] for tag_id in input_tag_ids]
-
-        output_tag_ids = [output_tag_map[tag_name] for tag_name in input_tag_names]
-
-        for tag_id, tag_value in zip(output_tag_ids, input_tag_values):
-            # to_upload[tag_id].append(output_image.id)
-            to_upload[output_image.id].append({"tagId": tag_id, "value": tag_value})
-
-    for image_id, tag_data in to_upload.items():
-        for tag in tag_data:
-            g.api.image.add_tag(image_id, tag["tagId"], tag["value"])
-
-
-def update_annotation(input_ann: sly.Annotation, img_size: Tuple[int, int]):
-    output_labels = [update_label(label) for label in input_ann.labels if update_label(label)]
-    output_ann = sly.Annotation(img_size=img_size, labels=output_labels)
-    return output_ann
-
-
-def add_tag_meta_to_output_project():
-    sly.logger.info("Will update TagMetas for output project...")
-    if not g.STATE.output_project_meta:
-        sly.logger.info("Output project meta is not set, creating new one...")
-        g.STATE.output_project_meta = sly.ProjectMeta()
-    for input_project_id in g.STATE.project_ids:
-        input_project_meta = sly.ProjectMeta.from_json(g.api.project.get_meta(input_project_id))
-
-        tag_metas = input_project_meta.tag_metas
-        for tag_meta in tag_metas:
-            g.STATE.output_project_meta: sly.ProjectMeta
-            existing_tag_meta = g.STATE.output_project_meta.get_tag_meta(tag_meta.name)
-            # Check if tag is already in output project meta to avoid duplicates
-            if existing_tag_meta is None:
-                g.STATE.output_project_meta = g.STATE.output_project_meta.add_tag_meta(tag_meta)
-                sly.logger.info(f'Added tag meta: "{tag_meta.name}" to output project meta.')
-            else:
-                sly.logger.info(
-                    f'Tag meta: "{tag_meta.name}" is already in output project meta, skipping...'
-                )
-
-    sly.logger.debug("Updated TagMetas for output project, will try to update it on instance...")
-    g.api.project.update_meta(g.STATE.output_project_id, g.STATE.output_project_meta)
-    sly.logger.debug("Updated output project meta on instance.")
-
-
-def update_label(input_label: sly.Label):
-    output_project_meta = g.STATE.output_project_meta
-    if not output_project_meta:
-        output_project_meta = sly.ProjectMeta()
-
-    if input_label.obj_class in output_project_meta.obj_classes:
-        return input_label
-
-    new_obj_class = input_label.obj_class
-    new_label = input_label
-
-    for tag in input_label.tags:
-        existing_tag_meta = output_project_meta.get_tag_meta(tag.name)
-        # Check if tag is already in output project meta to avoid duplicates
-        if existing_tag_meta is None:
-            output_project_meta = output_project_meta.add_tag_meta(tag.meta)
-            sly.logger.info(f'Added tag meta: "{tag.name}" to output project meta.')
-        else:
-            sly.logger.info(
-                f'Tag meta: "{tag.name}" is already in output project meta, skipping...'
-            )
-
-    for obj_class in output_project_meta.obj_classes:
-        if obj_class.name == input_label.obj_class.name:
-            if obj_class.geometry_type != input_label.obj_class.geometry_type:
-                sly.logger.debug(
-                    f"Output project meta already contanins object class with name {obj_class.name}, "
-                    f"Existing geometry type: {obj_class.geometry_type}, new geometry type: "
-                    f"{input_label.obj_class.geometry_type}."
-                )
-
-                if g.STATE.conflict_settings.class_conflicts == "Skip":
-                    sly.logger.debug(
-                        "Conflict resolution is set to 'Skip', skipping label with "
-                        f"object class {input_label.obj_class.name}..."
-                    )
-                    return
-                elif g.STATE.conflict_settings.class_conflicts == "Rename":
-                    sly.logger.debug(
-                        f"Conflict resolution is set to 'Rename', renaming object class "
-                        f"{input_label.obj_class.name} according to its geometry type..."
-                    )
-
-                    new_obj_class = input_label.obj_class.clone(
-                        name=f"{input_label.obj_class.name}_{input_label.obj_class.geometry_type.geometry_name()}"
-                    )
-
-                    new_label = input_label.clone(obj_class=new_obj_class)
+    from src.main import app
 
-    try:
-        output_project_meta = output_project_meta.add_obj_class(new_obj_class)
-        g.STATE.output_project_meta = output_project_meta
-        g.api.project.update_meta(g.STATE.output_project_id, g.STATE.output_project_meta)
-    except DuplicateKeyError:
-        sly.logger.debug(
-            f"Output project meta already contanins object class with name {new_obj_class.name}. "
-            "Project meta was not updated."
-        )
+    app.stop()
 
-    return new_label
 
+def show_result(text: str, status: str):
+    result_text.text = text
+    result_text.status = status
+    result_text.show()
 
-def create_dataset(dataset_name: str, parent_id: int = None) -> sly.DatasetInfo:
-    return g.api.dataset.create(
-        g.STATE.output_project_id,
-        dataset_name,
-        change_name_if_conflict=True,
-        parent_id=parent_id,
-    )
+    merge_button.text = "Merge"
+    merge_button.enable()
+    plan_button.enable()
+    cancel_button.text = "Cancel"
+    cancel_button.enable()
+    cancel_button.hide()
@@ -23,6 +23,15 @@ class_conflict_field = Field(
     content=class_conflict_select,
 )
 
+duplicate_images_select = Select(
+    items=[Select.Item(value=value) for value in g.DUPLICATE_IMAGES]
+)
+duplicate_images_field = Field(
+    title="Duplicate images",
+    description="How to handle images with the same content in the input projects.",
+    content=duplicate_images_select,
+)
+
 lock_settings_button = Button(
     text="Save settings",
     icon="zmdi zmdi-lock",
@@ -41,6 +50,7 @@ card = Card(
         [
             image_conflict_field,
             class_conflict_field,
+            duplicate_images_field,
             lock_settings_button,
         ],
     ),
@@ -57,6 +67,7 @@ def lock_settings():
     g.STATE.conflict_settings = g.ConflictSettings(
         image_conflicts=image_conflict_select.get_value(),
         class_conflicts=class_conflict_select.get_value(),
+        duplicate_images=duplicate_images_select.get_value(),
     )
 
     sly.logger.info(
@@ -0,0 +1,53 @@
+from typing import List, Optional, Tuple
+
+import supervisely as sly
+
+from src.sync_index import get_source_meta
+
+
+class ImageWork:
+    """Upload work of a single input image, with only the fields the upload needs.
+
+    The window is planned as one list of these records instead of parallel lists of image
+    infos, annotations, names and IDs, so filtering the window never breaks their alignment.
+    Output fields are filled as the image goes through the upload: the name is None if
+    the image is skipped, and the ID is set when the image is uploaded.
+    """
+
+    __slots__ = (
+        "input_image_id",
+        "name",
+        "meta",
+        "updated_at",
+        "tags",
+        "labels_count",
+        "hash",
+        "link",
+        "ann",
+        "duplicate_tags",
+        "output_image_name",
+        "output_image_id",
+    )
+
+    def __init__(
+        self,
+        image_info: sly.ImageInfo,
+        ann: Optional[dict],
+        duplicate_tags: List[Tuple[int, List[dict]]],
+    ):
+        self.input_image_id: int = image_info.id
+        self.name: str = image_info.name
+        # Output image meta, which records the source of the image for the sync.
+        self.meta: dict = get_source_meta(image_info)
+        self.updated_at: Optional[str] = image_info.updated_at
+        self.tags: List[dict] = image_info.tags
+        self.labels_count: int = image_info.labels_count
+        # Hash and link are all that upload_ids reads from the image infos.
+        self.hash: Optional[str] = image_info.hash
+        self.link: Optional[str] = image_info.link
+        # None if the annotation is copied server-side without downloading.
+        self.ann = ann
+        # (input project ID, image tags) of the duplicates, which are merged into the image.
+        self.duplicate_tags = duplicate_tags
+        self.output_image_name: Optional[str] = None
+        self.output_image_id: Optional[int] = None